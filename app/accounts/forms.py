@@ -2,8 +2,9 @@ import uuid
 
 from flask import url_for
 from flask.ext.login import current_user
-from wtforms import SubmitField
-from wtforms.validators import DataRequired, ValidationError
+from wtforms import SubmitField, SelectField, FloatField
+from wtforms.validators import DataRequired, ValidationError, Optional, \
+    NumberRange
 
 from app.accounts.models import Project, FreeEmailProvider
 from common.forms import BaseForm, TrackChangesStringField
@@ -42,6 +43,11 @@ class ProjectForm(BaseForm):
     intercom_app_id = default_string_field(
         'intercom app_id', validators=[UniqueValue(model_class=Project)])
     intercom_api_key = default_string_field('intercom api_key')
+    intercom_export_engine = SelectField('export engine',
+                                         choices=Project.EXPORT_ENGINES,
+                                         default='pages')
+    intercom_notes_rate = FloatField(
+        'notes per second', validators=[Optional(), NumberRange(min=0)])
 
     aws_access_id = default_string_field('AWS access_id')
     aws_secret_access_key = default_string_field('AWS secret_access_key')
@@ -1,4 +1,7 @@
-from app.accounts.utils import create_admin as _create_admin
+from app.accounts.utils import (create_admin as _create_admin,
+                                FREE_EMAILS_FILE,
+                                import_free_email_providers as _import_feps,
+                                export_free_email_providers as _export_feps)
 
 
 from app import manager
@@ -7,3 +10,25 @@ from app import manager
 @manager.command
 def create_admin():
     _create_admin()
+
+
+@manager.command
+def import_free_email_providers(path=FREE_EMAILS_FILE):
+    """ Add domains from the file (one per line) to free email providers.
+    """
+    with open(path, 'r') as f:
+        added = _import_feps(f)
+
+    print('{0} new domains are added'.format(len(added)))
+
+
+@manager.command
+def export_free_email_providers(path=FREE_EMAILS_FILE):
+    """ Save free email providers to the file (one per line).
+    """
+    domains = _export_feps()
+
+    with open(path, 'w') as f:
+        f.writelines('{0}\n'.format(d) for d in domains)
+
+    print('{0} domains are saved'.format(len(domains)))
@@ -1,7 +1,7 @@
 from flask_user import UserMixin
 from flask.ext.login import current_user
 
-from app import db
+from app import app, db
 from common import models
 from common.awis import AWISContextManager
 
@@ -36,9 +36,26 @@ class Project(db.Model, models.BaseModelMixin, models.CreateAndModifyMixin):
 
     intercom_app_id = db.Column(db.Unicode(255), nullable=False, unique=True)
     intercom_api_key = db.Column(db.Unicode(255), nullable=False)
-    intercom_webhooks_internal_secret = db.Column(db.Unicode(255))
+    intercom_webhooks_internal_secret = db.Column(db.Unicode(255),
+                                                  index=True)
     intercom_subscription_id = db.Column(db.Unicode(255))
 
+    # How to fetch existing users from Intercom
+    EXPORT_ENGINES = (
+        ('pages', 'Pagination'),
+        ('scroll', 'Scroll API (for large workspaces)'),
+    )
+    intercom_export_engine = db.Column(db.Unicode(16), nullable=False,
+                                       default='pages',
+                                       server_default='pages')
+
+    # Unix time of the latest update of users imported from Intercom. The
+    # next import fetches only users updated after that.
+    intercom_users_updated_at = db.Column(db.Integer())
+
+    # Notes per second for all workers (INTERCOM_NOTES_RATE if not set)
+    intercom_notes_rate = db.Column(db.Float())
+
     aws_access_id = db.Column(db.Unicode(255), nullable=False)
     aws_secret_access_key = db.Column(db.Unicode(255), nullable=False)
 
@@ -57,15 +74,31 @@ class Project(db.Model, models.BaseModelMixin, models.CreateAndModifyMixin):
         return cls.get_or_404(cls.user_id == current_user.id, cls.id == pk)
 
     def get_intercom_client(project):
-        from app.intercom.service import IntercomClient
+        if app.config['INTERCOM_ASYNC_CLIENT']:
+            from app.intercom.async_service import \
+                SyncIntercomClient as IntercomClient
+        else:
+            from app.intercom.service import IntercomClient
+
+        rate_limiter = None
+        if app.config['INTERCOM_RATE_LIMIT']:
+            from app.intercom.ratelimit import RateLimiter
+            rate_limiter = RateLimiter(project.intercom_app_id)
+
+        from app.intercom.ratelimit import get_notes_pacer
+
         return IntercomClient(project.intercom_app_id,
-                              project.intercom_api_key)
+                              project.intercom_api_key,
+                              rate_limiter=rate_limiter,
+                              notes_pacer=get_notes_pacer(
+                                  project.intercom_app_id,
+                                  project.intercom_notes_rate))
 
-    def start_awis_session(project):
+    def start_awis_session(project, **kwargs):
         """ Initiate contextmanager for working with AWIS.
         """
         return AWISContextManager(project.aws_access_id,
-                                  project.aws_secret_access_key)
+                                  project.aws_secret_access_key, **kwargs)
 
     def delete(self):
         client = self.get_intercom_client()
@@ -1,10 +1,12 @@
+import json
 import logging
 from collections import defaultdict
 
+from funcy import chunks
 from requests.exceptions import ReadTimeout, ConnectionError, HTTPError
-from funcy.seqs import ichunks
 
 from app import celery, app
+from common.awis import Extractor, Field
 
 
 logger = logging.getLogger(__name__)
@@ -17,9 +19,17 @@ def handle_intercom_users(project_id):
     """ Background task which runs after creation of project.
     Fetch and filter users from Intercom. After that call task for
     fetching information from the AWIS.
+
+    Progress is saved after every page, so a retry continues from the
+    last completed page instead of the first one.
+
+    If users of the project have been imported before, only users updated
+    since then are fetched, and only new users or users with a changed
+    domain go to the AWIS.
     """
     from app.accounts.models import Project
     from app.intercom.models import IntercomUser
+    from app.intercom.checkpoint import ImportCheckpoint
 
     # Maximum items per request for Intercom's bulk update
     CHUNK_SIZE = 100
@@ -29,17 +39,32 @@ def handle_intercom_users(project_id):
         logger.error('Project with id == {} does not exist'.format(project_id))
         return
 
-    def _fetch_users():
-        for user in IntercomUser.iter_and_sync(project):
-            if not user.is_useful_domain:
-                logger.info('Unuseful domain: %s. Skip.', user.domain)
-                continue
+    checkpoint = ImportCheckpoint(project_id)
+    state = checkpoint.load()
 
-            yield user.transformed_email
+    if state['url']:
+        logger.info('Resume import for project %s from %s (%s pages done)',
+                    project_id, state['url'], state['pages'])
+    elif not state['pages']:
+        # Without the watermark it is a full import: all users found in
+        # Intercom go to the AWIS
+        state['since'] = project.intercom_users_updated_at
+
+    pages = []
+    # The last page has been synced already if there is no URL to continue
+    if state['url'] or not state['pages']:
+        pages = IntercomUser.iter_pages_and_sync(
+            project, url=state['url'],
+            bulk=IntercomUser.is_bulk_supported(), since=state['since'])
 
     try:
-        for emails in ichunks(CHUNK_SIZE, _fetch_users()):
-            fetch_and_update_information.delay(emails, project_id)
+        for users, next_url, updated_at in pages:
+            state['url'] = next_url
+            state['updated_at'] = max(state['updated_at'], updated_at)
+            state['pages'] += 1
+            state['users'] += len(users)
+            state['useful'] += sum(u.is_useful_domain for u in users)
+            checkpoint.save(state)
     except (ReadTimeout, ConnectionError) as e:
         handle_intercom_users.retry(exc=e)
     except HTTPError as e:
@@ -48,6 +73,20 @@ def handle_intercom_users(project_id):
         else:
             raise e
 
+    # Every domain is looked up in the AWIS once for all its users
+    for domains in IntercomUser.iter_pending_domains(project, CHUNK_SIZE):
+        fetch_and_update_domains.delay(domains, project_id)
+
+    # The next import will fetch only users updated after this one
+    project.intercom_users_updated_at = max(state['updated_at'],
+                                            state['since'] or 0) or None
+    project.save()
+
+    checkpoint.clear()
+    logger.info('Import for project %s is finished: %s pages, %s users, '
+                '%s with useful domains', project_id, state['pages'],
+                state['users'], state['useful'])
+
 
 @celery.task(default_retry_delay=1, max_retries=3)
 def fetch_and_update_information(emails, project_id):
@@ -64,53 +103,220 @@ def fetch_and_update_information(emails, project_id):
         key, value = e.split('@')[::-1]
         domains_map[key].append(value)
 
-    with project.start_awis_session() as awis:
-        awis.url_info(domains_map.keys(),
-                      'UsageStats', 'SiteData', 'Language', 'RankByCountry')
-
-        for domain, node, result_row in awis.iter_results('ContentData'):
-            result_row['lang'] = awis.get_value(node, 'Language/Locale')
-            result_row['site_data'] = {
-                'title': awis.get_value(
-                    node, 'SiteData/Title', default='-'),
-                'description': awis.get_value(
-                    node, 'SiteData/Description', default='-'),
-                'online_since': awis.get_value(
-                    node, 'SiteData/OnlineSince', default='-'),
-            }
-
-        for domain, node, result_row in awis.iter_results('TrafficData'):
-            if result_row['lang']:
-                result_row['country_rank'] = awis.get_value(
-                    node, 'Country[@Code="{0}"]Rank'.format(
-                        result_row['lang'].upper()))
-
-            # Try to determinate the best rank over all countries by raw select
-            if result_row['country_rank'] is None:
-                result_row['country_rank'] = min([
-                    int(e.text) for e in
-                    node.findall('.//awis:Country/awis:Rank',
-                                 awis.api.NS_PREFIXES)
-                    if e.text] or [None])
-
-            result_row['rank_value'] = awis.get_value(
-                node, 'Reach/Rank/Value')
-
-            result_row['per_million'] = awis.get_value(
-                node, 'Reach/PerMillion/Value')
-
-            result_row['page_views_per_million'] = awis.get_value(
-                node, 'PageViews/PerMillion/Value')
+    update_information(project, domains_map)
+
+
+@celery.task(default_retry_delay=1, max_retries=3)
+def fetch_and_update_domains(domains, project_id):
+    """ The same as ``fetch_and_update_information`` but for all users of
+    the project with given domains which are waiting for an update.
+    """
+    from app.accounts.models import Project
+    from app.intercom.models import IntercomUser
+
+    project = Project.query.filter(Project.id == project_id).first()
+    if not project:
+        logger.error('Project with id == %s does not exist', project_id)
+        return
+
+    domains_map, versions = IntercomUser.get_pending_users(project, domains)
+    update_information(project, domains_map)
+
+    IntercomUser.clear_pending(project, versions)
+
+
+@task
+def reclassify_domains(domains, is_useful):
+    """ The domains were added to (or removed from) the free email providers
+    list: change ``is_useful_domain`` of their users and erase (or fetch)
+    information about them. Users are sent to these tasks by chunks.
+
+    On PostgreSQL users of many domains are changed by one statement per
+    batch of users. A batch is committed after its users are sent.
+    """
+    from app.intercom.models import IntercomUser
+
+    CHUNK_SIZE = 100
+    DOMAINS_PER_QUERY = 500
+    USERS_PER_QUERY = 1000
+
+    if not IntercomUser.is_bulk_supported():
+        for domain in domains:
+            reclassify_domain(domain, is_useful)
+        return
+
+    for part in chunks(DOMAINS_PER_QUERY, domains):
+        for changed in IntercomUser.iter_reclassified(part, is_useful,
+                                                      USERS_PER_QUERY):
+            for project_id, users in changed.items():
+                logger.info('Reclassify %s users of project %s',
+                            len(users), project_id)
+
+                for chunk in chunks(CHUNK_SIZE, users):
+                    send_reclassified(project_id, chunk, is_useful)
+
+
+def reclassify_domain(domain, is_useful):
+    """ The same for one domain: users are changed project by project.
+    """
+    from app.intercom.models import IntercomUser
+
+    CHUNK_SIZE = 100
+
+    for project_id in IntercomUser.get_changed_projects(domain, is_useful):
+        users = IntercomUser.iter_changed_users(project_id, domain, is_useful,
+                                                CHUNK_SIZE)
+
+        for chunk in users:
+            send_reclassified(project_id, chunk, is_useful)
+
+        IntercomUser.set_useful_domain(project_id, domain, is_useful)
+
+
+def send_reclassified(project_id, users, is_useful):
+    """ Fetch (or erase) information for users like [(user_id, domain), ...]
+    """
+    if is_useful:
+        fetch_and_update_information.delay(
+            ['{}@{}'.format(user_id, domain) for user_id, domain in users],
+            project_id)
+    else:
+        erase_awis_information.delay([user_id for user_id, _ in users],
+                                     project_id)
+
+
+@task
+def flush_hooks_buffer(project_id, force=False):
+    """ Send emails from webhooks of the project to the AWIS by full batches.
+    With ``force`` the rest of the buffer is sent as well.
+    """
+    from app.intercom.buffer import HooksBuffer
+
+    size = app.config['HOOKS_BUFFER_SIZE']
+    buffer = HooksBuffer(project_id)
+
+    while force or len(buffer) >= size:
+        emails = buffer.pop(size)
+        if not emails:
+            break
+
+        logger.info('Flush %s emails from webhooks of project %s',
+                    len(emails), project_id)
+        fetch_and_update_information.delay(emails, project_id)
+
+
+@task
+def ingest_hooks(project_id, force=False):
+    """ Save users from buffered events of webhooks of the project by
+    batches and put useful ones into the buffer for the AWIS.
+    With ``force`` the rest of the buffer is handled as well.
+    """
+    from app import db
+    from app.accounts.models import Project
+    from app.intercom.models import IntercomUser
+    from app.intercom.buffer import HooksBuffer, HookEventsBuffer
+
+    size = app.config['HOOKS_BUFFER_SIZE']
+    events = HookEventsBuffer(project_id)
+
+    project = Project.query.filter(Project.id == project_id).first()
+    if not project:
+        logger.error('Project with id == %s does not exist', project_id)
+        events.pop(len(events))
+        return
+
+    while force or len(events) >= size:
+        batch = events.pop(size)
+        if not batch:
+            break
+
+        users_data = [json.loads(e) for e in batch]
+
+        try:
+            if IntercomUser.is_bulk_supported():
+                rows = IntercomUser.bulk_sync(project, users_data,
+                                              pending=False)
+            else:
+                rows = [
+                    IntercomUser.get_or_create(project, user_id, email)
+                    for user_id, email in IntercomUser.clean_users_data(
+                        users_data)]
+                db.session.commit()
+        except Exception:
+            # Intercom doesn't send them again: keep for the next attempt
+            db.session.rollback()
+            events.unpop(*batch)
+            raise
+
+        emails = [r.transformed_email for r in rows if r.is_useful_domain]
+        logger.info('Ingest %s users from webhooks of project %s (%s useful)',
+                    len(rows), project_id, len(emails))
+
+        if emails:
+            HooksBuffer(project_id).push(*emails)
+
+    flush_hooks_buffer(project_id)
+
 
+@task
+def flush_hooks_buffers():
+    """ Periodic task: save buffered events of webhooks and flush buffers
+    which are waiting for too long.
+    """
+    from app.intercom.buffer import HooksBuffer, HookEventsBuffer
+
+    # Every project is handled by its own task: one failure doesn't stop
+    # the others
+    for project_id in HookEventsBuffer.get_expired(0):
+        ingest_hooks.delay(project_id, force=True)
+
+    for project_id in HooksBuffer.get_expired(
+            app.config['HOOKS_BUFFER_MAX_AGE']):
+        flush_hooks_buffer.delay(project_id, force=True)
+
+
+@task
+def refresh_awis_cache(domains, project_id):
+    """ Fetch stale domains from the AWIS again to update the cache.
+    """
+    from app.accounts.models import Project
+
+    project = Project.query.filter(Project.id == project_id).first()
+    if not project:
+        logger.error('Project with id == %s does not exist', project_id)
+        return
+
+    logger.info('Refresh AWIS cache for %s', domains)
+    fetch_information(project, domains, refresh=True)
+
+
+def update_information(project, domains_map):
+    """ Fetch information about domains from the AWIS and put it to
+    Intercom for users of these domains.
+    ``domains_map`` is a dict like {domain.com: [users_id, user_id], ...}
+
+    Users are sent to Intercom by batches as soon as information about
+    their domains is ready, while the rest of domains are being fetched.
+    """
+    BULK_SIZE = 50  # Intercom's limit for the bulk update
+
+    intercom = project.get_intercom_client()
     notes = []
     users = []
 
-    for domain, data in awis.session_result.items():
+    def flush():
+        intercom.update_users(users, prefix='AWIS')
+        intercom.create_notes(notes)
+        del users[:], notes[:]
+
+    for domain, data in iter_information(project, domains_map.keys()):
         note_body = (
             'Title: {title}\n'
             'Descr: {description}\n'
             'Since: {online_since}\n'.format(
-                **data.pop('site_data')))
+                **data['site_data']))
+
+        data = {k: v for k, v in data.items() if k != 'site_data'}
 
         for user_id in domains_map[domain]:
             # Put note to the bulk update
@@ -119,9 +325,85 @@ def fetch_and_update_information(emails, project_id):
             # Put user to the bulk update
             users.append(dict(user_id=user_id, custom_attributes=data))
 
-    intercom = project.get_intercom_client()
-    intercom.update_users(users, prefix='AWIS')
-    intercom.create_notes(notes)
+            if len(users) >= BULK_SIZE:
+                flush()
+
+    if users:
+        flush()
+
+
+def fetch_information(project, domains, refresh=False):
+    """ Fetch information about domains from the AWIS (or the cache).
+    Returns a dict like {domain.com: {'lang': ..., ...}, ...}
+    """
+    return dict(iter_information(project, domains, refresh))
+
+
+def iter_information(project, domains, refresh=False):
+    """ The same as ``fetch_information`` but yields pairs like
+    (domain.com, {'lang': ..., ...}) as soon as they are ready.
+    """
+    def on_stale(domains):
+        refresh_awis_cache.delay(domains, project.id)
+
+    with project.start_awis_session(refresh=refresh,
+                                    on_stale=on_stale) as awis:
+        yield from awis.iter_url_info(
+            domains, 'UsageStats', 'SiteData', 'Language', 'RankByCountry',
+            parse=parse_url_info)
+
+
+def country_rank(node):
+    """ Returns a pair like ('US', '123') for a ``Country`` node.
+    """
+    rank = next((e.text for e in node
+                 if e.tag.rpartition('}')[2] == 'Rank'), None)
+    return node.get('Code'), rank
+
+
+CONTENT_DATA = Extractor(
+    Field('lang', 'Language/Locale'),
+    Field('title', 'SiteData/Title', default='-'),
+    Field('description', 'SiteData/Description', default='-'),
+    Field('online_since', 'SiteData/OnlineSince', default='-'),
+)
+
+TRAFFIC_DATA = Extractor(
+    Field('countries', 'Country', many=True, node=True,
+          type=country_rank),
+    Field('rank_value', 'Reach/Rank/Value'),
+    Field('per_million', 'Reach/PerMillion/Value'),
+    Field('page_views_per_million', 'PageViews/PerMillion/Value'),
+)
+
+
+def parse_url_info(awis, tree):
+    """ Put information from a response of the AWIS into the session result.
+    """
+    for domain, node, result_row in awis.iter_results('ContentData', tree):
+        data = CONTENT_DATA(node)
+        result_row['lang'] = data['lang']
+        result_row['site_data'] = {
+            'title': data['title'],
+            'description': data['description'],
+            'online_since': data['online_since'],
+        }
+
+    for domain, node, result_row in awis.iter_results('TrafficData', tree):
+        data = TRAFFIC_DATA(node)
+        ranks = {code: rank for code, rank in data['countries'] if rank}
+
+        if result_row['lang']:
+            result_row['country_rank'] = ranks.get(result_row['lang'].upper())
+
+        # Try to determinate the best rank over all countries
+        if result_row['country_rank'] is None:
+            result_row['country_rank'] = min(
+                map(int, ranks.values()), default=None)
+
+        result_row['rank_value'] = data['rank_value']
+        result_row['per_million'] = data['per_million']
+        result_row['page_views_per_million'] = data['page_views_per_million']
 
 
 @task
@@ -1,7 +1,149 @@
+import os
+import time
+import logging
 from datetime import datetime
+from threading import Lock
 
-from app import app
-from app.accounts import User, FreeEmailProvider
+from funcy import chunks
+from redis import Redis
+
+from app import app, db, redis_pool, PROJECT_ROOT
+from app.accounts import User, Project, FreeEmailProvider
+from app.accounts.tasks import reclassify_domains
+from common.models import post_save, post_delete
+
+
+logger = logging.getLogger(__name__)
+
+FREE_EMAILS_FILE = os.path.join(PROJECT_ROOT, 'free.emails')
+
+
+class FreeEmailProvidersIndex:
+    """ Process-local set of free email domains. Membership checks don't
+    touch the database: the set is reloaded only when the version counter
+    in Redis has been bumped (by this or any other process).
+    """
+    version_key = 'FEP:index:version'
+
+    def __init__(self):
+        self.redis = Redis(connection_pool=redis_pool)
+        self.lock = Lock()
+        self.domains = frozenset()
+        self.version = None
+        self.loaded = False
+        self.checked_at = 0
+
+    def __contains__(self, domain):
+        self.refresh()
+        return domain in self.domains
+
+    def refresh(self):
+        """ Reload the set if it was changed since the last check. Redis is
+        asked at most once per ``FREE_EMAIL_PROVIDERS_CHECK_INTERVAL``.
+        """
+        interval = app.config['FREE_EMAIL_PROVIDERS_CHECK_INTERVAL']
+
+        if self.loaded and time.time() - self.checked_at < interval:
+            return
+
+        with self.lock:
+            version = self.redis.get(self.version_key)
+            self.checked_at = time.time()
+
+            if self.loaded and version == self.version:
+                return
+
+            self.domains = self.load()
+            self.version = version
+            self.loaded = True
+
+    def load(self):
+        # The table is seeded from free.emails once (by the migration or
+        # the import_free_email_providers command): an empty table is
+        # a valid (empty) list
+        domains = frozenset(
+            d for d, in FreeEmailProvider.query.with_entities(
+                FreeEmailProvider.domain))
+
+        logger.info('Free email providers index loaded: %s domains',
+                    len(domains))
+        return domains
+
+    def invalidate(self, sender=None, **kwargs):
+        """ Force all processes (this one immediately) to reload the set.
+        """
+        self.redis.incr(self.version_key)
+        self.checked_at = 0
+
+
+free_email_providers = FreeEmailProvidersIndex()
+
+post_save.connect(free_email_providers.invalidate,
+                  sender='accounts.FreeEmailProvider')
+post_delete.connect(free_email_providers.invalidate,
+                    sender='accounts.FreeEmailProvider')
+
+
+class WebhookSecrets:
+    """ Map of internal secrets of Intercom's webhooks to ids of projects.
+    Lookups go to the process-local dict, then to the Redis hash and only
+    then to the database. Changes of projects reset the map everywhere.
+    """
+    key = 'intercom:hooks:secrets'
+    version_key = 'intercom:hooks:secrets:version'
+    check_interval = 5
+
+    def __init__(self):
+        self.redis = Redis(connection_pool=redis_pool)
+        self.local = {}
+        self.version = None
+        self.checked_at = 0
+
+    def get(self, secret):
+        """ Returns id of the project or None.
+        """
+        self.refresh()
+
+        if secret in self.local:
+            return self.local[secret]
+
+        project_id = self.redis.hget(self.key, secret)
+
+        if project_id is None:
+            row = Project.query.with_entities(Project.id).filter(
+                Project.intercom_webhooks_internal_secret == secret).first()
+            if row is None:
+                return None
+
+            project_id = row.id
+            self.redis.hset(self.key, secret, project_id)
+
+        self.local[secret] = int(project_id)
+        return self.local[secret]
+
+    def refresh(self):
+        if time.time() - self.checked_at < self.check_interval:
+            return
+
+        version = self.redis.get(self.version_key)
+        self.checked_at = time.time()
+
+        if version != self.version:
+            self.local = {}
+            self.version = version
+
+    def invalidate(self, sender=None, **kwargs):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key)
+        pipe.incr(self.version_key)
+        pipe.execute()
+        self.checked_at = 0
+
+
+webhook_secrets = WebhookSecrets()
+
+post_save.connect(webhook_secrets.invalidate, sender='accounts.Project')
+post_delete.connect(webhook_secrets.invalidate, sender='accounts.Project')
 
 
 def email_is_useful(email, default=False):
@@ -12,13 +154,46 @@ def email_is_useful(email, default=False):
     if not domain:
         return default
 
-    return not FreeEmailProvider.exists(domain)
+    return domain not in free_email_providers
 
 
 def extract_domain(email):
     return (email or '').split('@')[-1].strip()
 
 
+def import_free_email_providers(domains):
+    """ Add domains which are not in the free email providers list yet by
+    multi-row inserts. Their users are reclassified by one background task
+    (instead of a task per domain). Returns the list of added domains.
+    """
+    CHUNK_SIZE = 500
+
+    domains = set(filter(None, (d.strip() for d in domains)))
+    exists = set(d for d, in FreeEmailProvider.query.with_entities(
+        FreeEmailProvider.domain))
+    new = sorted(domains - exists)
+
+    if not new:
+        return []
+
+    table = FreeEmailProvider.__table__
+    for chunk in chunks(CHUNK_SIZE, new):
+        db.session.execute(table.insert().values([
+            {'domain': domain} for domain in chunk]))
+    db.session.commit()
+
+    free_email_providers.invalidate()
+    reclassify_domains.delay(new, False)
+
+    logger.info('Free email providers imported: %s new domains', len(new))
+    return new
+
+
+def export_free_email_providers():
+    return [d for d, in FreeEmailProvider.query.with_entities(
+        FreeEmailProvider.domain).order_by(FreeEmailProvider.domain.asc())]
+
+
 def create_admin():
     email = app.config['ADMIN_USER']['email']
     password = app.config['ADMIN_USER']['password']
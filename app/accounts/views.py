@@ -1,7 +1,8 @@
 import json
 import logging
 
-from flask import request, Blueprint, abort, redirect, url_for, flash
+from flask import (request, Blueprint, abort, redirect, url_for, flash,
+                   Response)
 from flask.ext.user import login_required
 from flask.ext.login import current_user
 
@@ -9,9 +10,14 @@ from common.decorators import render_to
 from app import app, csrf
 from app.accounts.models import Project, FreeEmailProvider
 from app.accounts.forms import ProjectForm, FreeEmailProviderForm
-from app.accounts.tasks import (fetch_and_update_information,
-                                handle_intercom_users)
+from app.accounts.tasks import (handle_intercom_users, flush_hooks_buffer,
+                                ingest_hooks)
+from app.accounts.utils import (webhook_secrets,
+                                import_free_email_providers,
+                                export_free_email_providers)
 from app.intercom.models import IntercomUser
+from app.intercom.buffer import HooksBuffer, HookEventsBuffer
+from app.intercom.checkpoint import ImportCheckpoint
 
 
 accounts_app = Blueprint('accounts', __name__)
@@ -83,6 +89,13 @@ def project_update(pk):
 
     if form.validate_on_submit():
         form.populate_obj(project)
+
+        # With a new key progress of the previous import doesn't make sense.
+        # Re-Import continues the previous one (or fetches updated users).
+        if form.intercom_api_key.is_changed:
+            ImportCheckpoint(project.id).clear()
+            project.intercom_users_updated_at = None
+
         project.save()
         flash('Project has been updated', 'success')
 
@@ -108,6 +121,9 @@ def project_remove(pk):
 @csrf.exempt
 @accounts_app.route('/projects/hook/<internal_secret>/', methods=('POST',))
 def handle_intercom_hooks(internal_secret):
+    if app.config['INTERCOM_HOOKS_DEFERRED']:
+        return handle_intercom_hooks_deferred(internal_secret)
+
     project = Project.query.filter(
         Project.intercom_webhooks_internal_secret == internal_secret).first()
 
@@ -122,13 +138,37 @@ def handle_intercom_hooks(internal_secret):
         user['email'],
         commit=True)
 
-    # TODO: put email into the stack (or use special flag in IntercomUser)
-    # and make an actual call of the fetch_and_update_information e.g.
-    # every hour  with all of these emails.
-
+    # Emails are sent to the AWIS by batches (see flush_hooks_buffers)
     if intercom_user.is_useful_domain:
-        fetch_and_update_information.delay([intercom_user.transformed_email],
-                                           project.id)
+        size = app.config['HOOKS_BUFFER_SIZE']
+        length = HooksBuffer(project.id).push(intercom_user.transformed_email)
+
+        if length % size == 0:
+            flush_hooks_buffer.delay(project.id)
+
+    return json.dumps({'status': 'ok'})
+
+
+def handle_intercom_hooks_deferred(internal_secret):
+    """ Only put the event into the project's buffer: users are saved by
+    batches in background (see ingest_hooks).
+    """
+    project_id = webhook_secrets.get(internal_secret)
+
+    if project_id is None:
+        raise abort(400)
+
+    try:
+        user = request.json['data']['item']
+        event = json.dumps({'user_id': user['user_id'],
+                            'email': user['email']})
+    except (KeyError, TypeError):
+        raise abort(400)
+
+    length = HookEventsBuffer(project_id).push(event)
+
+    if length % app.config['HOOKS_BUFFER_SIZE'] == 0:
+        ingest_hooks.delay(project_id)
 
     return json.dumps({'status': 'ok'})
 
@@ -150,6 +190,34 @@ def free_email_providers_list():
     return locals()
 
 
+@accounts_app.route('/fep/import/', methods=('POST',))
+@login_required
+def free_email_providers_import():
+    """ Add many domains at once: from an uploaded file and/or the text field
+    (one domain per line).
+    """
+    domains = request.form.get('domains', '').splitlines()
+
+    upload = request.files.get('file')
+    if upload:
+        domains.extend(upload.read().decode('utf-8').splitlines())
+
+    added = import_free_email_providers(domains)
+    flash('{0} email providers have been added'.format(len(added)),
+          'success')
+    return redirect(url_for('accounts.free_email_providers_list'))
+
+
+@accounts_app.route('/fep/export/')
+@login_required
+def free_email_providers_export():
+    domains = export_free_email_providers()
+    return Response(
+        ''.join('{0}\n'.format(d) for d in domains),
+        mimetype='text/plain',
+        headers={'Content-Disposition': 'attachment; filename=free.emails'})
+
+
 @accounts_app.route('/fep/<int:pk>/remove/', methods=('POST',))
 @login_required
 def free_email_provider_remove(pk):
@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import threading
+
+import aiohttp
+import requests
+from funcy import log_calls, pluck, chunks
+
+from app.intercom.service import (IntercomClient, IntercomValidationError,
+                                  TIMEOUT, RETRY_COUNT, _timeout,
+                                  apply_prefix_for_user_data,
+                                  is_duplicate_note)
+
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_connector = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """ The one event loop of the process. It runs in a background thread,
+    so it can be used from any thread (web requests, Celery tasks).
+    """
+    global _loop
+
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                                      name='intercom-event-loop',
+                                      daemon=True)
+            thread.start()
+
+    return _loop
+
+
+def get_connector():
+    """ Connection pool shared by all async clients of the process.
+    Must be called from the loop.
+    """
+    global _connector
+    from app import app
+
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(
+            limit=app.config['INTERCOM_ASYNC_POOL_SIZE'])
+
+    return _connector
+
+
+class AsyncIntercomClient:
+    """ The same as ``IntercomClient`` but built on asyncio.
+    Concurrency is bounded by a semaphore instead of a number of threads.
+    """
+    base_url = IntercomClient.base_url
+    get_users_url = IntercomClient.get_users_url
+
+    def __init__(self, app_id, api_key, workers_count=100,
+                 rate_limiter=None, notes_pacer=None):
+        self.app_id = app_id
+        self.api_key = api_key
+        self.auth = aiohttp.BasicAuth(app_id, api_key)
+        self.workers_count = workers_count
+        self.rate_limiter = rate_limiter
+        self.notes_pacer = notes_pacer
+        self._semaphore = None
+        self._session = None
+        # Number of operations in progress (see __aenter__)
+        self._users = 0
+
+    def get_headers(self, **extra):
+        default = {'Accept': 'application/json'}
+        default.update(extra)
+        return default
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers_count)
+        return self._semaphore
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=get_connector(),
+                connector_owner=False,
+                auth=self.auth,
+                headers=self.get_headers(),
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        self._users += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """ The session is closed when the last operation is finished.
+        """
+        self._users -= 1
+        if not self._users:
+            await self.close()
+
+    async def run_in_executor(self, func, *args):
+        """ Blocking calls (e.g. Redis of the rate limiter) must not stop
+        the loop: run them in the default executor.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            None, func, *args)
+
+    async def request(self, method, url, **kwargs):
+        """ Make a request with retries. Returns decoded JSON.
+        """
+        for i in range(RETRY_COUNT):
+            if self.rate_limiter:
+                await asyncio.sleep(
+                    await self.run_in_executor(self.rate_limiter.reserve))
+
+            try:
+                async with self.semaphore:
+                    async with self.session.request(
+                            method, url, **kwargs) as response:
+                        if self.rate_limiter:
+                            await self.run_in_executor(
+                                self.rate_limiter.update,
+                                response.headers)
+
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if i == RETRY_COUNT - 1:
+                    raise
+                await asyncio.sleep(_timeout(i))
+
+    async def iter_pages(self, per_page=50, order='desc', url=None,
+                         sort=None):
+        VALID_ORDERS = ('desc', 'asc')
+        if order not in VALID_ORDERS:
+            raise IntercomValidationError('order can by %s' % VALID_ORDERS)
+
+        url = url or self.get_users_url(per_page, order, sort)
+
+        while url:
+            response = await self.request('GET', url)
+            url = response['pages']['next']
+            yield response['users'], url
+
+    async def iter_scroll_pages(self, url=None):
+        scroll_url = '{0}/users/scroll'.format(self.base_url)
+        url = url or scroll_url
+
+        while True:
+            try:
+                response = await self.request('GET', url)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404 or url == scroll_url:
+                    raise
+
+                logger.warning('Scroll cursor is expired. Start over.')
+                url = scroll_url
+                continue
+
+            if not response['users']:
+                break
+
+            url = '{0}?scroll_param={1}'.format(
+                scroll_url, response['scroll_param'])
+
+            yield response['users'], url
+
+    async def iter_users(self, per_page=50, order='desc'):
+        async for users, _ in self.iter_pages(per_page, order):
+            for user_data in users:
+                yield user_data
+
+    async def update_users(self, users_data, prefix=None):
+        """ Uses Intercom's bulk update.
+        """
+        CHUNK_SIZE = 50  # Intercom's limitation
+        url = '{0}/bulk/users'.format(self.base_url)
+
+        async def request(chunk_of_users_data):
+            result = await self.request('POST', url, json={'items': [
+                {
+                    'method': 'post',
+                    'data_type': 'user',
+                    'data': apply_prefix_for_user_data(ch, prefix)
+                } for ch in chunk_of_users_data]
+            })
+
+            try:
+                logger.debug('Bulk update status: %s',
+                             result['links']['self'])
+            except KeyError:
+                logger.error('Weird response from Intercom: %r', result)
+
+            return result
+
+        await asyncio.gather(*[
+            request(chunk) for chunk in chunks(CHUNK_SIZE, users_data)])
+
+    async def update_user(self, user_data, prefix=None):
+        return await self.request(
+            'POST', '{0}/users'.format(self.base_url),
+            json=apply_prefix_for_user_data(user_data, prefix))
+
+    async def create_notes(self, data, force=False):
+        url = '{0}/notes'.format(self.base_url)
+        data = list(data)
+
+        if not force:
+            exist_notes = await self.get_notes(pluck('user_id', data))
+            data = [row for row in data
+                    if not is_duplicate_note(row, exist_notes)]
+
+        async def request(row):
+            if self.notes_pacer:
+                await asyncio.sleep(
+                    await self.run_in_executor(self.notes_pacer.reserve))
+
+            return await self.request('POST', url, json=dict(
+                user={'user_id': row['user_id']}, body=row['body']))
+
+        await asyncio.gather(*[request(row) for row in data])
+
+    async def get_notes(self, users_ids):
+        """ Fetch notes for users. Returns a dict like: {user_id: [note, note]}
+        """
+        url = '{0}/notes'.format(self.base_url)
+
+        async def request(user_id):
+            result = await self.request('GET', url,
+                                        params={'user_id': user_id})
+            return str(user_id), result['notes']
+
+        return dict(await asyncio.gather(*[
+            request(user_id) for user_id in users_ids]))
+
+    async def subscribe(self, hook_url, topics):
+        return await self.request(
+            'POST', '{0}/subscriptions'.format(self.base_url),
+            json=dict(service_type='web', url=hook_url, topics=topics))
+
+    async def unsubscribe(self, subscription_id):
+        return await self.request(
+            'DELETE', '{0}/subscriptions/{1}'.format(
+                self.base_url, subscription_id))
+
+
+def to_requests_error(error):
+    """ Exception of ``requests`` which ``IntercomClient`` would raise
+    instead of the given one of aiohttp (or None if there is no such).
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return requests.exceptions.ReadTimeout(str(error))
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        response = requests.Response()
+        response.status_code = error.status
+        response.reason = error.message
+        request_info = getattr(error, 'request_info', None)
+        response.url = str(request_info.url) if request_info else None
+        return requests.exceptions.HTTPError(
+            '%s %s' % (error.status, error.message), response=response)
+
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return requests.exceptions.ConnectionError(str(error))
+
+    if isinstance(error, aiohttp.ClientError):
+        return requests.exceptions.RequestException(str(error))
+
+
+class SyncIntercomClient:
+    """ Blocking facade over ``AsyncIntercomClient`` with the interface of
+    ``IntercomClient``. Coroutines are executed on the process-wide loop.
+    """
+    def __init__(self, app_id, api_key, workers_count=100,
+                 rate_limiter=None, notes_pacer=None):
+        self.client = AsyncIntercomClient(app_id, api_key, workers_count,
+                                          rate_limiter, notes_pacer)
+        self.app_id = app_id
+        self.api_key = api_key
+        self.workers_count = workers_count
+
+    def run(self, coro):
+        """ Errors are raised as exceptions of ``requests``, so callers
+        (e.g. retries of tasks) work the same as with ``IntercomClient``.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+        try:
+            return future.result()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = to_requests_error(e)
+            if error is None:
+                raise
+            raise error from e
+
+    def call(self, method, *args):
+        """ Run the method of the async client. Its session is closed when
+        no other operation uses it.
+        """
+        async def call():
+            async with self.client:
+                return await getattr(self.client, method)(*args)
+
+        return self.run(call())
+
+    def iter_async(self, iterator):
+        self.run(self.client.__aenter__())
+
+        try:
+            while True:
+                try:
+                    yield self.run(iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            self.run(self.client.__aexit__(None, None, None))
+
+    def close(self):
+        self.run(self.client.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_pages(self, per_page=50, order='desc', url=None, sort=None):
+        return self.iter_async(
+            self.client.iter_pages(per_page, order, url, sort))
+
+    def iter_scroll_pages(self, url=None):
+        return self.iter_async(self.client.iter_scroll_pages(url))
+
+    @log_calls(logger.debug)
+    def iter_users(self, per_page=50, order='desc'):
+        for users, _ in self.iter_pages(per_page, order):
+            for user_data in users:
+                yield user_data
+
+    @log_calls(logger.debug)
+    def update_users(self, users_data, prefix=None):
+        return self.call('update_users', users_data, prefix)
+
+    @log_calls(logger.debug)
+    def update_user(self, user_data, prefix=None):
+        return self.call('update_user', user_data, prefix)
+
+    @log_calls(logger.debug)
+    def create_notes(self, data, force=False):
+        return self.call('create_notes', data, force)
+
+    @log_calls(logger.debug)
+    def get_notes(self, users_ids):
+        return self.call('get_notes', users_ids)
+
+    @log_calls(logger.debug)
+    def subscribe(self, hook_url, topics):
+        return self.call('subscribe', hook_url, topics)
+
+    @log_calls(logger.debug)
+    def unsubscribe(self, subscription_id):
+        return self.call('unsubscribe', subscription_id)
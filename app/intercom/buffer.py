@@ -0,0 +1,100 @@
+import time
+import logging
+
+from redis import Redis
+
+from app import redis_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+class HooksBuffer:
+    """ Emails from Intercom's webhooks of a project which are waiting for
+    information from the AWIS. They are sent by full batches (see
+    ``flush_hooks_buffer``) or when the oldest one is waiting for too long.
+    """
+    key_tmpl = 'intercom:hooks:buffer:%s'
+    # Projects with non-empty buffers: {project_id: time of the oldest item}
+    index_key = 'intercom:hooks:buffers'
+
+    # KEYS[1] - the buffer; KEYS[2] - the index;
+    # ARGV[1] - project id; ARGV[2] - current time;
+    # ARGV[3] - RPUSH (to the tail) or LPUSH (to the head); ARGV[4:] - items.
+    PUSH_SCRIPT = """
+        local length = redis.call(ARGV[3], KEYS[1], unpack(ARGV, 4))
+        if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+            redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+        end
+        return length
+    """
+
+    # KEYS[1] - the buffer; KEYS[2] - the index;
+    # ARGV[1] - project id; ARGV[2] - max number of items;
+    # ARGV[3] - current time.
+    # Times of items are not kept: the rest of the buffer is counted from
+    # the pop, otherwise it would be expired (and flushed) at once.
+    POP_SCRIPT = """
+        local items = redis.call('LRANGE', KEYS[1], 0, ARGV[2] - 1)
+        redis.call('LTRIM', KEYS[1], #items, -1)
+        if redis.call('LLEN', KEYS[1]) == 0 then
+            redis.call('ZREM', KEYS[2], ARGV[1])
+        elseif #items > 0 then
+            redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+        end
+        return items
+    """
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.key = self.key_tmpl % project_id
+        self.redis = Redis(connection_pool=redis_pool)
+        self._push = self.redis.register_script(self.PUSH_SCRIPT)
+        self._pop = self.redis.register_script(self.POP_SCRIPT)
+
+    def push(self, *items):
+        """ Returns the length of the buffer.
+        """
+        return self._push(keys=[self.key, self.index_key],
+                          args=[self.project_id, time.time(), 'RPUSH'] +
+                          list(items))
+
+    def unpop(self, *items):
+        """ Put popped items back to the head of the buffer (e.g. if they
+        haven't been handled). Returns the length of the buffer.
+        """
+        if not items:
+            return len(self)
+
+        return self._push(keys=[self.key, self.index_key],
+                          args=[self.project_id, time.time(), 'LPUSH'] +
+                          list(reversed(items)))
+
+    def pop(self, count):
+        """ Take up to ``count`` oldest items.
+        """
+        if count <= 0:
+            return []
+
+        items = self._pop(keys=[self.key, self.index_key],
+                          args=[self.project_id, count, time.time()])
+        return [i.decode('utf-8') for i in items]
+
+    def __len__(self):
+        return self.redis.llen(self.key)
+
+    @classmethod
+    def get_expired(cls, age):
+        """ Ids of projects which have items older than ``age`` seconds.
+        """
+        redis = Redis(connection_pool=redis_pool)
+        return [int(i) for i in redis.zrangebyscore(
+            cls.index_key, '-inf', time.time() - age)]
+
+
+class HookEventsBuffer(HooksBuffer):
+    """ Raw events from Intercom's webhooks of a project (JSON) which are
+    waiting to be saved (see ``ingest_hooks``).
+    """
+    key_tmpl = 'intercom:hooks:events:%s'
+    index_key = 'intercom:hooks:events'
@@ -0,0 +1,53 @@
+import json
+import logging
+
+from redis import Redis
+
+from app import redis_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImportCheckpoint:
+    """ State of the import of Intercom's users for a project: the URL of the
+    next page to fetch plus counters. Saved after every completed page so a
+    retried (or repeated) import continues from there.
+    """
+    key_tmpl = 'intercom:import:checkpoint:%s'
+    expire = 60 * 60 * 24  # 1 day
+
+    def __init__(self, project_id):
+        self.key = self.key_tmpl % project_id
+        self.redis = Redis(connection_pool=redis_pool)
+
+    @staticmethod
+    def initial():
+        return {
+            'url': None,
+            'pages': 0,
+            'users': 0,
+            'useful': 0,
+            # Watermark of the previous import and the latest update time of
+            # users seen during this one (see handle_intercom_users)
+            'since': None,
+            'updated_at': 0,
+        }
+
+    def load(self):
+        """ Returns saved state or the initial one.
+        """
+        value = self.redis.get(self.key)
+
+        if not value:
+            return self.initial()
+
+        state = self.initial()
+        state.update(json.loads(value.decode('utf-8')))
+        return state
+
+    def save(self, state):
+        self.redis.set(self.key, json.dumps(state), ex=self.expire)
+
+    def clear(self):
+        self.redis.delete(self.key)
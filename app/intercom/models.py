@@ -1,12 +1,14 @@
 import logging
+from collections import OrderedDict, defaultdict
 
-from funcy import with_prev
+from funcy import chunks
+from sqlalchemy import or_, and_, func, any_, bindparam, select
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 
 from app import db
 from common import models
 from app.accounts.utils import email_is_useful, extract_domain
-from app.accounts.tasks import (fetch_and_update_information,
-                                erase_awis_information)
+from app.accounts.tasks import reclassify_domains
 
 
 logger = logging.getLogger(__name__)
@@ -32,14 +34,211 @@ class IntercomUser(db.Model, models.BaseModelMixin):
 
     is_useful_domain = db.Column(db.Boolean(), nullable=False, default=False)
 
+    # Information from the AWIS must be fetched (again) for the user
+    is_awis_pending = db.Column(db.Boolean(), nullable=False, default=False,
+                                server_default='false')
+    # Incremented every time the user is marked: the flag is cleared only
+    # if the user hasn't been marked again since it was read
+    awis_pending_version = db.Column(db.Integer(), nullable=False, default=0,
+                                     server_default='0')
+
+    # Not stored: set by the sync when the user is new or its domain changed
+    is_changed = True
+
     def __unicode__(self):
         return '{0.project_id}:{0.user_id}'.format(self)
 
     @classmethod
-    def iter_and_sync(cls, project):
+    def iter_pages_and_sync(cls, project, url=None, bulk=True, since=None):
+        """ Sync users page by page (each page is committed right away).
+        Yields ``(rows, next_url, updated_at)``, where ``next_url`` can be
+        passed as ``url`` to continue from the next page and ``updated_at``
+        is the latest update time of users of the page.
+
+        With ``since`` (timestamp) only users updated after that are synced
+        and only new and changed ones are marked as waiting for the AWIS.
+        Otherwise (a full import) all synced users are marked. Users which
+        are not found in Intercom anymore are never marked.
+        With ``bulk`` every page is written by a single upsert (requires
+        PostgreSQL).
+        """
         client = project.get_intercom_client()
 
-        for user_data in client.iter_users():
+        if project.intercom_export_engine == 'scroll':
+            # Scroll doesn't support sorting: check all users
+            pages = client.iter_scroll_pages(url=url)
+        elif since:
+            pages = client.iter_pages(url=url, sort='updated_at')
+        else:
+            pages = client.iter_pages(url=url)
+
+        for users_data, next_url in pages:
+            updated_at = max([u.get('updated_at') or 0 for u in users_data]
+                             or [0])
+
+            if since:
+                fresh = [u for u in users_data
+                         if (u.get('updated_at') or 0) > since]
+
+                # Users are sorted by updated_at: the rest are older
+                if len(fresh) < len(users_data) and \
+                        project.intercom_export_engine != 'scroll':
+                    next_url = None
+
+                users_data = fresh
+
+            if bulk:
+                rows = cls.bulk_sync(project, users_data,
+                                     all_pending=not since)
+            else:
+                rows = [
+                    cls.get_or_create(project, user_id, email, commit=False)
+                    for user_id, email in cls.clean_users_data(users_data)]
+
+                for row in rows:
+                    if row.is_changed or not since:
+                        row.is_awis_pending = row.is_useful_domain
+                        row.awis_pending_version = \
+                            (row.awis_pending_version or 0) + 1
+
+                db.session.commit()
+
+            yield rows, next_url, updated_at
+
+            if not next_url:
+                break
+
+    @classmethod
+    def bulk_sync(cls, project, users_data, pending=True, all_pending=False):
+        """ Insert or update given users with one statement.
+        Returns list of (not attached to the session) rows.
+        With ``pending`` new and changed users are marked as waiting for
+        information from the AWIS. With ``all_pending`` all given users are
+        marked (and returned as changed).
+        """
+        rows = OrderedDict()
+
+        for user_id, email in cls.clean_users_data(users_data):
+            user_id = int(user_id)
+            rows[user_id] = cls(project_id=project.id,
+                                user_id=user_id,
+                                domain=extract_domain(email),
+                                is_useful_domain=email_is_useful(email))
+
+        if not rows:
+            return []
+
+        stmt = cls.get_sync_statement(rows.values(), pending, all_pending)
+        changed = set(user_id for user_id, in db.session.execute(stmt))
+        db.session.commit()
+
+        for row in rows.values():
+            row.is_changed = row.user_id in changed
+
+        return list(rows.values())
+
+    @classmethod
+    def get_sync_statement(cls, rows, pending=True, all_pending=False):
+        """ Upsert of given rows for ``bulk_sync`` (PostgreSQL only) which
+        returns ``user_id`` of new and changed ones.
+        """
+        stmt = insert(cls.__table__).values([
+            dict(project_id=r.project_id,
+                 user_id=r.user_id,
+                 domain=r.domain,
+                 is_useful_domain=r.is_useful_domain,
+                 is_awis_pending=(pending or all_pending) and
+                 r.is_useful_domain)
+            for r in rows])
+
+        # Existing rows are updated (and returned) only if they changed,
+        # unless all of them are marked
+        table = cls.__table__
+        where = None if all_pending else or_(
+            table.c.domain != stmt.excluded.domain,
+            table.c.is_useful_domain != stmt.excluded.is_useful_domain,
+        )
+
+        return stmt.on_conflict_do_update(
+            index_elements=[cls.project_id, cls.user_id],
+            set_=dict(domain=stmt.excluded.domain,
+                      is_useful_domain=stmt.excluded.is_useful_domain,
+                      # Users waiting for the AWIS stay waiting
+                      is_awis_pending=and_(
+                          stmt.excluded.is_useful_domain,
+                          or_(table.c.is_awis_pending,
+                              stmt.excluded.is_awis_pending)),
+                      awis_pending_version=table.c.awis_pending_version + 1),
+            where=where,
+        ).returning(table.c.user_id)
+
+    @classmethod
+    def iter_pending_domains(cls, project, size):
+        """ Iterate over chunks of domains of users waiting for information
+        from the AWIS. Every chunk covers about ``size`` users.
+        """
+        rows = db.session.query(cls.domain, func.count(cls.id)).filter(
+            cls.project_id == project.id,
+            cls.is_awis_pending.is_(True),
+        ).group_by(cls.domain).order_by(cls.domain)
+
+        chunk, count = [], 0
+        for domain, users_count in rows:
+            chunk.append(domain)
+            count += users_count
+
+            if count >= size:
+                yield chunk
+                chunk, count = [], 0
+
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def get_pending_users(cls, project, domains):
+        """ Returns a dict like {domain.com: [users_id, user_id], ...} of
+        users waiting for information from the AWIS and their versions
+        (for ``clear_pending``) like {user_id: version, ...}.
+        """
+        rows = db.session.query(
+            cls.domain, cls.user_id, cls.awis_pending_version
+        ).filter(
+            cls.project_id == project.id,
+            cls.domain.in_(domains),
+            cls.is_awis_pending.is_(True),
+        )
+
+        result, versions = defaultdict(list), {}
+        for domain, user_id, version in rows:
+            result[domain].append(str(user_id))
+            versions[str(user_id)] = version
+
+        return result, versions
+
+    @classmethod
+    def clear_pending(cls, project, versions):
+        """ Clear the flag of users from ``get_pending_users`` unless they
+        have been marked again since then.
+        """
+        users_by_version = defaultdict(list)
+        for user_id, version in versions.items():
+            users_by_version[version].append(int(user_id))
+
+        for version, users_ids in users_by_version.items():
+            cls.query.filter(
+                cls.project_id == project.id,
+                cls.user_id.in_(users_ids),
+                cls.awis_pending_version == version,
+            ).update({cls.is_awis_pending: False},
+                     synchronize_session=False)
+
+        db.session.commit()
+
+    @staticmethod
+    def clean_users_data(users_data):
+        """ Skip users without email or user_id. Yields (user_id, email).
+        """
+        for user_data in users_data:
             if not user_data['email']:
                 logger.error('User don\'t have an email. Skip it.')
                 continue
@@ -49,14 +248,7 @@ class IntercomUser(db.Model, models.BaseModelMixin):
                 logger.error('User don\'t have an user_id. Skip it.')
                 continue
 
-            email, user_id = user_data['email'], user_data['user_id']
-            logger.info('Handle email: %s', email)
-            row = cls.get_or_create(project, user_id, email, commit=False)
-
-            yield row
-
-        # TODO: write/find a contextprocessor for this?
-        db.session.commit()
+            yield user_data['user_id'], user_data['email']
 
     @property
     def transformed_email(self):
@@ -75,8 +267,13 @@ class IntercomUser(db.Model, models.BaseModelMixin):
             logger.info('Create information about new user: %s', email)
             row = cls(project_id=project.id, user_id=user_id)
 
-        row.is_useful_domain = email_is_useful(email)
-        row.domain = extract_domain(email)
+        domain = extract_domain(email)
+        is_useful_domain = email_is_useful(email)
+        row.is_changed = (row.id is None or row.domain != domain or
+                          row.is_useful_domain != is_useful_domain)
+
+        row.is_useful_domain = is_useful_domain
+        row.domain = domain
         db.session.add(row)
 
         if commit:
@@ -85,62 +282,117 @@ class IntercomUser(db.Model, models.BaseModelMixin):
         return row
 
     @classmethod
-    def iterate_over_changed_items(cls, domain, is_useful, commit=True):
-        """ Iterator which changes ``.is_useful_domain`` property and gives a
-        way to do are addition actions after that (e.g. commit changes :)
+    def iter_reclassified(cls, domains, is_useful, size):
+        """ Change ``is_useful_domain`` of all users with the domains by
+        statements of up to ``size`` users (PostgreSQL only). Yields changed
+        users of every statement as a dict like
+        {project_id: [(user_id, domain), ...], ...}
+
+        A batch is committed only when the caller asks for the next one, so
+        users are not lost if the caller fails to handle them.
         """
-        rows = cls.query.filter(
-            cls.domain == domain, cls.is_useful_domain != is_useful
-        ).order_by(cls.project_id.asc()).all()
+        stmt = cls.get_reclassify_statement(domains, is_useful, size)
 
-        for row, prev_row in with_prev(rows):
-            row.is_useful_domain = is_useful
-            db.session.add(row)
+        while True:
+            result = defaultdict(list)
+            for project_id, user_id, domain in db.session.execute(stmt):
+                result[project_id].append((user_id, domain))
 
-            yield row, prev_row
+            if not result:
+                db.session.commit()
+                return
+
+            try:
+                yield result
+            except BaseException:
+                db.session.rollback()
+                raise
 
-        if commit:
             db.session.commit()
 
+    @classmethod
+    def get_reclassify_statement(cls, domains, is_useful, size):
+        """ Update of up to ``size`` users for ``iter_reclassified``
+        (PostgreSQL only) which returns their project_id, user_id and domain.
+        """
+        table = cls.__table__
+        domains = bindparam('domains', list(domains),
+                           type_=ARRAY(db.Unicode(255)))
+
+        # Changed users don't match anymore: every batch takes the next ones
+        batch = select([table.c.id]).where(and_(
+            table.c.domain == any_(domains),
+            table.c.is_useful_domain != is_useful,
+        )).order_by(table.c.project_id, table.c.id).limit(size)
+
+        return table.update().where(
+            table.c.id.in_(batch)
+        ).values(
+            is_useful_domain=is_useful
+        ).returning(table.c.project_id, table.c.user_id, table.c.domain)
+
+    @staticmethod
+    def is_bulk_supported():
+        """ Statements like upserts and UPDATE ... RETURNING are supported
+        by PostgreSQL only.
+        """
+        return db.engine.dialect.name == 'postgresql'
+
+    @classmethod
+    def get_changed_projects(cls, domain, is_useful):
+        """ Ids of projects which have users with the domain and another
+        value of ``is_useful_domain``.
+        """
+        rows = db.session.query(cls.project_id).filter(
+            cls.domain == domain, cls.is_useful_domain != is_useful
+        ).distinct()
+
+        return [project_id for project_id, in rows]
+
+    @classmethod
+    def iter_changed_users(cls, project_id, domain, is_useful, size):
+        """ The same but iterate over chunks of ``size`` users of the project.
+        Rows (with ``user_id`` and ``domain``) are fetched by a server-side
+        cursor.
+        """
+        rows = db.session.query(cls.user_id, cls.domain).filter(
+            cls.project_id == project_id,
+            cls.domain == domain,
+            cls.is_useful_domain != is_useful,
+        ).yield_per(size)
+
+        return chunks(size, rows)
+
+    @classmethod
+    def set_useful_domain(cls, project_id, domain, is_useful):
+        """ Change ``is_useful_domain`` of users of the project by one query.
+        """
+        cls.query.filter(
+            cls.project_id == project_id,
+            cls.domain == domain,
+            cls.is_useful_domain != is_useful,
+        ).update({cls.is_useful_domain: is_useful},
+                 synchronize_session=False)
+        db.session.commit()
+
 
 class FreeEmailProviderListChanged:
     """ Register common common operations which need to process when the
-    FreeEmailProvider has been added or deleted.
+    FreeEmailProvider has been added or deleted. Users are handled by
+    a background task.
     """
-    def __init__(self, signal, task, is_useful_domain, collect_attribute):
-        self.task = task
-        self.collect_attribute = collect_attribute
+    def __init__(self, signal, is_useful_domain):
         self.is_useful_domain = is_useful_domain
         signal.connect(self, sender='accounts.FreeEmailProvider')
 
     def __call__(self, sender, instance, **kwargs):
-        users = IntercomUser.iterate_over_changed_items(
-            instance.domain, self.is_useful_domain, commit=False)
-
-        tmp = []
-        for user, prev_user in users:
-            # Project changed: commit our changes
-            if prev_user and user.project_id != prev_user.project_id:
-                db.session.commit()
-                self.task.delay(tmp, prev_user.project_id)
-                tmp = []
-
-            tmp.append(getattr(user, self.collect_attribute))
-
-        # If after iteration we still have unstaged data
-        if tmp:
-            db.session.commit()
-            self.task.delay(tmp, user.project_id)
+        reclassify_domains.delay([instance.domain], self.is_useful_domain)
 
 
 free_email_provider_added = \
     FreeEmailProviderListChanged(signal=models.post_save,
-                                 task=erase_awis_information,
-                                 is_useful_domain=False,
-                                 collect_attribute='user_id')
+                                 is_useful_domain=False)
 
 free_email_provider_deleted = \
-    FreeEmailProviderListChanged(signal=models.pre_delete,
-                                 task=fetch_and_update_information,
-                                 is_useful_domain=True,
-                                 collect_attribute='transformed_email')
+    FreeEmailProviderListChanged(signal=models.post_delete,
+                                 is_useful_domain=True)
@@ -0,0 +1,187 @@
+import time
+import random
+import logging
+from threading import Lock
+
+from redis import Redis
+
+from app import redis_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """ Token bucket shared by all workers of one Intercom app. The bucket is
+    kept in Redis and filled from ``X-RateLimit-*`` headers of responses, so
+    requests are spread evenly until the reset instead of bursting into 429.
+    Ref: https://developers.intercom.io/docs/rate-limiting
+    """
+    key_tmpl = 'intercom:ratelimit:%s'
+
+    # Returns how many seconds the caller must wait before the request.
+    # KEYS[1] - the bucket; ARGV[1] - current time.
+    # Slots are spread by ``interval`` (the last known time per request), so
+    # waiters don't burst when the limit is reset.
+    RESERVE_SCRIPT = """
+        local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+        local reset = tonumber(redis.call('HGET', KEYS[1], 'reset'))
+        local interval = tonumber(redis.call('HGET', KEYS[1], 'interval'))
+        local now = tonumber(ARGV[1])
+
+        if remaining == nil or reset == nil then
+            return '0'
+        end
+
+        local slot = tonumber(redis.call('HGET', KEYS[1], 'next') or now)
+        if slot < now then
+            slot = now
+        end
+
+        if now >= reset then
+            -- No response from the new window yet: keep the previous pace
+            if interval == nil then
+                return '0'
+            end
+            redis.call('HSET', KEYS[1], 'next', slot + interval)
+        elseif remaining > 0 then
+            interval = (reset - now) / remaining
+            redis.call('HSET', KEYS[1], 'remaining', remaining - 1)
+            redis.call('HSET', KEYS[1], 'interval', interval)
+            redis.call('HSET', KEYS[1], 'next', slot + interval)
+        else
+            slot = math.max(slot, reset)
+            redis.call('HSET', KEYS[1], 'next', slot + (interval or 0))
+        end
+
+        return tostring(slot - now)
+    """
+
+    # KEYS[1] - the bucket; ARGV[1] - remaining; ARGV[2] - reset.
+    UPDATE_SCRIPT = """
+        local reset = tonumber(redis.call('HGET', KEYS[1], 'reset'))
+        local remaining = tonumber(ARGV[1])
+
+        -- Responses of the same window may come in any order
+        if reset == tonumber(ARGV[2]) then
+            local current = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+            if current ~= nil and current < remaining then
+                remaining = current
+            end
+        end
+
+        redis.call('HSET', KEYS[1], 'remaining', remaining)
+        redis.call('HSET', KEYS[1], 'reset', ARGV[2])
+        redis.call('EXPIRE', KEYS[1], 3600)
+    """
+
+    def __init__(self, app_id):
+        self.key = self.key_tmpl % app_id
+        self.redis = Redis(connection_pool=redis_pool)
+        self._reserve = self.redis.register_script(self.RESERVE_SCRIPT)
+        self._update = self.redis.register_script(self.UPDATE_SCRIPT)
+
+    def reserve(self):
+        """ Take a token. Returns a delay (in seconds) before the request.
+        """
+        return float(self._reserve(keys=[self.key], args=[time.time()]))
+
+    def acquire(self):
+        """ Block until the request is allowed.
+        """
+        delay = self.reserve()
+
+        if delay > 0:
+            logger.debug('Rate limit for %s: wait %.2f seconds',
+                         self.key, delay)
+            time.sleep(delay)
+
+    def update(self, headers):
+        """ Refill the bucket from headers of the Intercom's response.
+        """
+        try:
+            remaining = int(headers.get('X-RateLimit-Remaining'))
+            reset = int(headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return
+
+        self._update(keys=[self.key], args=[remaining, reset])
+
+
+class Pacer:
+    """ Scheduler which spreads requests of all workers of one Intercom app
+    evenly: not more than ``rate`` requests per second. The next free slot is
+    kept in Redis. ``jitter`` adds a random delay of up to this fraction of
+    the interval. Metrics are counted by the instance.
+    """
+    key_tmpl = 'intercom:pacer:%s'
+
+    # Returns how many seconds the caller must wait before the request.
+    # KEYS[1] - the next free slot; ARGV[1] - current time;
+    # ARGV[2] - interval between requests.
+    RESERVE_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local slot = tonumber(redis.call('GET', KEYS[1]) or now)
+        if slot < now then
+            slot = now
+        end
+
+        redis.call('SET', KEYS[1], slot + tonumber(ARGV[2]), 'EX', 3600)
+
+        return tostring(slot - now)
+    """
+
+    def __init__(self, app_id, rate, jitter=0):
+        self.key = self.key_tmpl % app_id
+        self.rate = rate
+        self.interval = 1.0 / rate if rate else 0
+        self.jitter = jitter
+        self.redis = Redis(connection_pool=redis_pool)
+        self._reserve = self.redis.register_script(self.RESERVE_SCRIPT)
+        self.lock = Lock()
+        self.requests = 0
+        self.waited = 0.0
+
+    def reserve(self):
+        """ Take the next slot. Returns a delay (in seconds) before
+        the request.
+        """
+        delay = 0.0
+        if self.interval:
+            delay = float(self._reserve(keys=[self.key],
+                                        args=[time.time(), self.interval]))
+
+        if self.jitter:
+            delay += random.uniform(0, self.jitter * self.interval)
+
+        with self.lock:
+            self.requests += 1
+            self.waited += delay
+
+        return delay
+
+    def wait(self):
+        delay = self.reserve()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def metrics(self):
+        return {
+            'rate': self.rate,
+            'requests': self.requests,
+            'waited': round(self.waited, 3),
+        }
+
+
+def get_notes_pacer(app_id, rate=None):
+    """ Pacer for creation of notes of an Intercom app. ``rate`` of
+    the project overrides ``INTERCOM_NOTES_RATE``.
+    """
+    from app import app
+
+    if rate is None:
+        rate = app.config['INTERCOM_NOTES_RATE']
+
+    return Pacer(app_id, rate, app.config['INTERCOM_NOTES_JITTER'])
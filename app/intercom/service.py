@@ -1,21 +1,88 @@
 import re
+import os
 import logging
-import time
-import random
 from copy import deepcopy
-from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import requests
+from requests.adapters import HTTPAdapter
 import bleach
 from funcy import retry, log_calls, pluck, chunks
 
+from common.executors import get_executor
+
 
 logger = logging.getLogger(__name__)
 
-session = requests.session()
 TIMEOUT = 30
 RETRY_COUNT = 3
 
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = Lock()
+
+
+def get_session(key=None):
+    """ HTTP session of an Intercom app (``key``). Every app has its own pool
+    of keep-alive connections, so concurrent imports don't take connections
+    of each other. Sessions are created once per process.
+    """
+    global _sessions_pid
+
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        if key not in _sessions:
+            _sessions[key] = create_session()
+
+    return _sessions[key]
+
+
+def create_session():
+    from app import app
+
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=app.config['INTERCOM_POOL_SIZE'])
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_pool_stats(session):
+    """ Returns a dict like {'connections': 2, 'requests': 10, 'idle': 1}.
+    ``connections`` is the number of connections opened by the session.
+
+    Counters are read from internals of urllib3, the missing ones are
+    skipped (so stats are zeros rather than an error after an upgrade).
+    """
+    stats = {'connections': 0, 'requests': 0, 'idle': 0}
+
+    for adapter in set(session.adapters.values()):
+        poolmanager = getattr(adapter, 'poolmanager', None)
+        pools = getattr(poolmanager, 'pools', None)
+
+        if pools is None:
+            continue
+
+        for key in list(pools.keys()):
+            # Pools may be dropped by other threads meanwhile
+            pool = pools.get(key)
+
+            if pool is None:
+                continue
+
+            stats['connections'] += getattr(pool, 'num_connections', 0)
+            stats['requests'] += getattr(pool, 'num_requests', 0)
+
+            idle = getattr(pool, 'pool', None)
+            stats['idle'] += idle.qsize() if idle is not None else 0
+
+    return stats
+
 
 def _timeout(i):
     from app import app
@@ -24,12 +91,6 @@ def _timeout(i):
     return 2 ** i
 
 
-def wait(wait_range=15):
-    wait_time = random.choice(range(wait_range))
-    logger.info('Wait %s seconds.', wait_time)
-    time.sleep(wait_time)
-
-
 requests_retry = retry(RETRY_COUNT, errors=requests.RequestException,
                        timeout=_timeout)
 
@@ -52,49 +113,132 @@ class IntercomClient:
     # See: https://github.com/nicolaiarocci/cerberus
     base_url = 'https://api.intercom.io'
 
-    def __init__(self, app_id, api_key, workers_count=10):
+    def __init__(self, app_id, api_key, workers_count=10, rate_limiter=None,
+                 notes_pacer=None):
         self.app_id = app_id
         self.api_key = api_key
         self.auth = (app_id, api_key)
         self.workers_count = workers_count
+        self.rate_limiter = rate_limiter
+        self.notes_pacer = notes_pacer
 
     def get_headers(self, **extra):
         default = {'Accept': 'application/json'}
         default.update(extra)
         return default
 
+    def get_users_url(self, per_page=50, order='desc', sort=None):
+        url = '{0}/users?page=1&per_page={1}&order={2}'.format(
+            self.base_url, per_page, order)
+
+        if sort:
+            url = '{0}&sort={1}'.format(url, sort)
+
+        return url
+
+    @property
+    def session(self):
+        return get_session(self.app_id)
+
+    @property
+    def pool_stats(self):
+        return get_pool_stats(self.session)
+
+    def send(self, method, url, **kwargs):
+        """ Make a request through the session of the app. Waits for a free
+        slot if the client has a rate limiter and feeds it with response
+        headers.
+        """
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+        response = getattr(self.session, method)(url, **kwargs)
+
+        if self.rate_limiter:
+            self.rate_limiter.update(response.headers)
+
+        return response
+
     def get_executor(self):
-        return ThreadPoolExecutor(self.workers_count)
+        return get_executor('intercom')
 
-    @log_calls(logger.debug)
-    def iter_users(self, per_page=50, order='desc'):
+    def map(self, fn, iterable):
+        """ Run requests in the shared executor, not more than
+        ``workers_count`` at once for the app.
+        """
+        return self.get_executor().map(fn, iterable, key=self.app_id,
+                                       limit=self.workers_count)
+
+    def iter_pages(self, per_page=50, order='desc', url=None, sort=None):
+        """ Iterate over pages of users. Yields ``(users, next_url)``.
+        Pass ``next_url`` as ``url`` to continue from the next page.
+        """
         VALID_ORDERS = ('desc', 'asc')
         if order not in VALID_ORDERS:
             raise IntercomValidationError('order can by %s' % VALID_ORDERS)
 
         @requests_retry
         def _request(url):
-            response = session.get(url,
-                                   auth=self.auth,
-                                   headers=self.get_headers(),
-                                   timeout=TIMEOUT)
+            response = self.send('get', url,
+                                 auth=self.auth,
+                                 headers=self.get_headers(),
+                                 timeout=TIMEOUT)
             response.raise_for_status()
             return response.json()
 
-        url = '{0}/users?page=1&per_page={1}&order={2}'.format(
-            self.base_url, per_page, order)
+        url = url or self.get_users_url(per_page, order, sort)
+
+        while url:
+            response = _request(url)
+            url = response['pages']['next']
+
+            yield response['users'], url
+
+    def iter_scroll_pages(self, url=None):
+        """ The same as ``iter_pages`` but uses the Scroll API: pages have the
+        maximum size and constant latency at any depth. A scroll cursor lives
+        for a minute, so the export starts over if ``url`` is expired.
+        Ref: https://developers.intercom.io/reference#iterating-over-all-users
+        """
+        scroll_url = '{0}/users/scroll'.format(self.base_url)
+
+        @requests_retry
+        def _request(url):
+            response = self.send('get', url,
+                                 auth=self.auth,
+                                 headers=self.get_headers(),
+                                 timeout=TIMEOUT)
+
+            if response.status_code == 404 and url != scroll_url:
+                return None
+
+            response.raise_for_status()
+            return response.json()
+
+        url = url or scroll_url
 
         while True:
             response = _request(url)
 
-            for user_data in response['users']:
-                yield user_data
+            if response is None:
+                logger.warning('Scroll cursor is expired. Start over.')
+                url = scroll_url
+                continue
 
-            if response['pages']['next']:
-                url = response['pages']['next']
-            else:
+            if not response['users']:
                 break
 
+            url = '{0}?scroll_param={1}'.format(
+                scroll_url, response['scroll_param'])
+
+            yield response['users'], url
+
+    @log_calls(logger.debug)
+    def iter_users(self, per_page=50, order='desc'):
+        for users, _ in self.iter_pages(per_page, order):
+            for user_data in users:
+                yield user_data
+
     @log_calls(logger.debug)
     def update_users(self, users_data, prefix=None):
         """ Uses Intercom's bulk update.
@@ -104,8 +248,8 @@ class IntercomClient:
         @requests_retry
         def request(chunk_of_users_data):
             url = '{0}/bulk/users'.format(self.base_url)
-            response = session.post(
-                url,
+            response = self.send(
+                'post', url,
                 json={'items': [
                     {
                         'method': 'post',
@@ -116,8 +260,8 @@ class IntercomClient:
                 auth=self.auth,
                 headers=self.get_headers(),
                 timeout=TIMEOUT)
-            # TODO: re-raise custom exception for 429 HTTP error
-            # for further handling (e.g. retry celery task)
+            # 429 is retried here: the rate limiter makes the next attempt
+            # wait for the reset of the limit
             response.raise_for_status()
             result = response.json()
 
@@ -129,9 +273,8 @@ class IntercomClient:
 
             return result
 
-        with self.get_executor() as executor:
-            for _ in executor.map(request, chunks(CHUNK_SIZE, users_data)):
-                pass
+        for _ in self.map(request, chunks(CHUNK_SIZE, users_data)):
+            pass
 
     @log_calls(logger.debug)
     def update_user(self, user_data, prefix=None):
@@ -140,8 +283,8 @@ class IntercomClient:
         @requests_retry
         def request(user_data):
             url = '{0}/users'.format(self.base_url)
-            response = session.post(
-                url,
+            response = self.send(
+                'post', url,
                 json=apply_prefix_for_user_data(user_data, prefix),
                 auth=self.auth,
                 headers=self.get_headers(),
@@ -157,10 +300,11 @@ class IntercomClient:
 
         @requests_retry
         def request(row):
-            wait()
+            if self.notes_pacer:
+                self.notes_pacer.wait()
 
-            response = session.post(
-                url,
+            response = self.send(
+                'post', url,
                 json=dict(user={'user_id': row['user_id']}, body=row['body']),
                 auth=self.auth,
                 headers=self.get_headers(),
@@ -177,24 +321,17 @@ class IntercomClient:
             exist_notes = self.get_notes(pluck('user_id', data))
 
             for row in data:
-                user_id, body = str(row['user_id']), row['body']
-
-                if user_id not in exist_notes:
+                if not is_duplicate_note(row, exist_notes):
                     yield row
-                    continue
 
-                bodies = map(normalize_note,
-                             pluck('body', exist_notes[user_id]))
-                if normalize_note(body) not in bodies:
-                    yield row
-                    continue
+        for _ in self.map(request, iter_data(data)):
+            pass
 
-                logger.debug(
-                    'The note with this body already exists: %r', row)
+        if self.notes_pacer:
+            logger.info('Notes pacing for %s: %r',
+                        self.app_id, self.notes_pacer.metrics)
 
-        with ThreadPoolExecutor(self.workers_count) as executor:
-            for _ in executor.map(request, iter_data(data)):
-                pass
+        logger.debug('Connections of %s: %r', self.app_id, self.pool_stats)
 
     @log_calls(logger.debug)
     def get_notes(self, users_ids):
@@ -204,8 +341,8 @@ class IntercomClient:
 
         @requests_retry
         def request(user_id):
-            response = session.get(
-                url,
+            response = self.send(
+                'get', url,
                 data={'user_id': user_id},
                 auth=self.auth,
                 headers=self.get_headers(),
@@ -218,9 +355,8 @@ class IntercomClient:
 
         result = {}
 
-        with ThreadPoolExecutor(self.workers_count) as executor:
-            for row in executor.map(request, users_ids):
-                result[row['user_id']] = row['notes']
+        for row in self.map(request, users_ids):
+            result[row['user_id']] = row['notes']
 
         return result
 
@@ -230,8 +366,8 @@ class IntercomClient:
 
         @requests_retry
         def request(hook_url, topics):
-            response = session.post(
-                url,
+            response = self.send(
+                'post', url,
                 json=dict(
                     service_type='web',
                     url=hook_url,
@@ -252,8 +388,8 @@ class IntercomClient:
 
         @requests_retry
         def request(url):
-            response = session.delete(
-                url,
+            response = self.send(
+                'delete', url,
                 auth=self.auth,
                 headers=self.get_headers()
             )
@@ -281,3 +417,19 @@ def normalize_note(body):
     """
     body = bleach.clean(body, strip=True)
     return re.sub('\s', '', body).lower()
+
+
+def is_duplicate_note(row, exist_notes):
+    """ Check that the same note already exists for the user.
+    """
+    user_id, body = str(row['user_id']), row['body']
+
+    if user_id not in exist_notes:
+        return False
+
+    bodies = map(normalize_note, pluck('body', exist_notes[user_id]))
+    if normalize_note(body) not in bodies:
+        return False
+
+    logger.debug('The note with this body already exists: %r', row)
+    return True
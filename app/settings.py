@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 
 ENVIRON = os.environ.get('ENVIRON', 'LOCAL')
 
@@ -31,6 +32,73 @@ CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://localhost:6379/9')
 
 REDIS_CONF = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/9')
 
+CELERYBEAT_SCHEDULE = {
+    'flush-hooks-buffers': {
+        'task': 'app.accounts.tasks.flush_hooks_buffers',
+        'schedule': timedelta(minutes=1),
+    },
+}
+
+# How often (in seconds) workers check that their local copy of the
+# free email providers list is still actual
+FREE_EMAIL_PROVIDERS_CHECK_INTERVAL = int(
+    os.environ.get('FREE_EMAIL_PROVIDERS_CHECK_INTERVAL', 5))
+
+# Use asyncio-based client for Intercom (see app/intercom/async_service.py)
+INTERCOM_ASYNC_CLIENT = bool(int(os.environ.get('INTERCOM_ASYNC_CLIENT', 0)))
+INTERCOM_ASYNC_POOL_SIZE = int(os.environ.get('INTERCOM_ASYNC_POOL_SIZE', 100))
+
+# Pace requests to Intercom by X-RateLimit-* headers (shared via Redis)
+INTERCOM_RATE_LIMIT = bool(int(os.environ.get('INTERCOM_RATE_LIMIT', 1)))
+
+# Notes are created not faster than N per second per Intercom app (by all
+# workers, paced via Redis). A project may set its own rate. Jitter is
+# a fraction of the interval between notes.
+INTERCOM_NOTES_RATE = float(os.environ.get('INTERCOM_NOTES_RATE', 5))
+INTERCOM_NOTES_JITTER = float(os.environ.get('INTERCOM_NOTES_JITTER', 0))
+
+# In-process LRU in front of the Redis cache of AWIS results
+# (size 0 disables it). Expire is in seconds.
+AWIS_LOCAL_CACHE_SIZE = int(os.environ.get('AWIS_LOCAL_CACHE_SIZE', 10000))
+AWIS_LOCAL_CACHE_EXPIRE = int(os.environ.get('AWIS_LOCAL_CACHE_EXPIRE', 3600))
+
+# Format of new entries of the AWIS cache: 'msgpack' or 'json'.
+# Entries in both formats (and plain JSON written before versioning)
+# can be read regardless of the setting.
+AWIS_CACHE_SERIALIZER = os.environ.get('AWIS_CACHE_SERIALIZER', 'msgpack')
+
+# How long (in seconds) to remember domains the AWIS has no data for
+AWIS_MISSING_CACHE_EXPIRE = int(
+    os.environ.get('AWIS_MISSING_CACHE_EXPIRE', 60 * 60 * 24))
+
+# AWIS results older than 7 days are refreshed in background. Until then
+# (or until this hard limit, in seconds) the old value is used.
+AWIS_CACHE_HARD_EXPIRE = int(
+    os.environ.get('AWIS_CACHE_HARD_EXPIRE', 60 * 60 * 24 * 30))
+
+# A worker fetching a domain holds it for this time (in seconds) after each
+# fetched chunk, other workers wait for it. Should cover a request of a chunk.
+AWIS_LEASE_EXPIRE = int(os.environ.get('AWIS_LEASE_EXPIRE', 30))
+
+# Size of the pool of keep-alive connections to Intercom, per Intercom app.
+# Should be not less than the number of workers of the client.
+INTERCOM_POOL_SIZE = int(os.environ.get('INTERCOM_POOL_SIZE', 20))
+
+# Threads shared by all tasks of a worker process (see common/executors.py).
+# Each project is limited by the number of workers of its client.
+INTERCOM_EXECUTOR_SIZE = int(os.environ.get('INTERCOM_EXECUTOR_SIZE', 50))
+AWIS_EXECUTOR_SIZE = int(os.environ.get('AWIS_EXECUTOR_SIZE', 20))
+
+# Webhooks only put events into Redis, users are saved by batches
+# in background (by a single upsert on PostgreSQL)
+INTERCOM_HOOKS_DEFERRED = bool(
+    int(os.environ.get('INTERCOM_HOOKS_DEFERRED', 1)))
+
+# Emails from Intercom's webhooks are sent to the AWIS by batches of this
+# size or when the oldest of them waits longer than the age (in seconds)
+HOOKS_BUFFER_SIZE = int(os.environ.get('HOOKS_BUFFER_SIZE', 100))
+HOOKS_BUFFER_MAX_AGE = int(os.environ.get('HOOKS_BUFFER_MAX_AGE', 300))
+
 AWIS_USER_LIMIT_FOR_PROJECT = int(os.environ.get('LIMIT_FOR_PROJECT', 30))
 
 try:
@@ -1,23 +1,40 @@
 import json
+import time
+import uuid
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
+import timeit
+from threading import Lock
+from functools import lru_cache
+from collections import defaultdict, namedtuple, OrderedDict
 
+import msgpack
 from awis import AwisApi
 from funcy import chunks
 from redis import Redis
 
-from app import redis_pool
+from app import app, redis_pool
+from common.executors import get_executor
 
 
 logger = logging.getLogger(__name__)
 
 
 class AWISContextManager:
-    def __init__(self, access_id, secret_access_key, workers_count=5):
+    # How long to wait for domains which are fetched by another worker
+    wait_timeout = 60
+    wait_interval = 0.5
+
+    def __init__(self, access_id, secret_access_key, workers_count=5,
+                 refresh=False, on_stale=None):
+        """ With ``refresh`` the cache is not read (but updated).
+        ``on_stale`` is called with a list of domains which are served from
+        the cache but should be refreshed in background.
+        """
         self.auth = (access_id.encode('utf-8'),
                      secret_access_key.encode('utf-8'))
         self.workers_count = workers_count
+        self.refresh = refresh
+        self.on_stale = on_stale
         self.closed = False
         self.cache = Cache()
 
@@ -25,35 +42,133 @@ class AWISContextManager:
         self.api = AwisApi(*self.auth)
         self.session_result = {}
         self.session_list_of_raw_result = []
+        # Domains which this session is fetching (and other workers wait)
+        self.leases = set()
+        # Domains which are being fetched by other workers
+        self.waiting = set()
+        # Domains which values are in the cache already
+        self.cached = set()
         return self
 
-    def __exit__(self, *args):
-        # Save new values (or update exists)
-        for d, data in self.session_result.items():
-            self.cache.set(d, data)
+    def __exit__(self, exc_type, *args):
+        # Results may be incomplete after an error: nothing is saved
+        # (parsed chunks are saved already)
+        if exc_type is None:
+            # Save new values (or update exists)
+            items = {d: v for d, v in self.session_result.items()
+                     if d not in self.cached}
+
+            # Remember domains the AWIS has no data for
+            items.update((d, MISSING) for d in self.leases
+                         if d not in self.session_result)
 
+            self.cache.set_many(items)
+
+        self.cache.release(self.leases)
         self.closed = True
 
-    def url_info(self, domains, *categories):
+        if self.cache.local:
+            logger.debug('Local AWIS cache: %r', self.cache.local.stats)
+
+    def url_info(self, domains, *categories, parse=None):
         """ Wrapper over `AwisApi.url_info` for parallel processing.
+
+        With ``parse`` every response is handled as soon as it arrives:
+        ``parse(session, tree)`` fills ``session_result`` and the tree is
+        dropped right after that. Otherwise trees are kept for
+        ``iter_results``.
+        """
+        for _ in self.iter_url_info(domains, *categories, parse=parse):
+            pass
+
+    def iter_url_info(self, domains, *categories, parse=None):
+        """ The same as ``url_info`` but yields pairs like (domain, result)
+        as soon as they are ready: cached ones first, the rest when their
+        chunk is fetched and parsed. The caller's work between items
+        overlaps with requests of the other chunks.
         """
         if self.closed:
             raise AttributeError('Session is closed')
 
         CHUNK_SIZE = 5  # AWIS`s limit
 
-        def request(domains, categories):
+        def request(domains):
             logger.info('AWIS request for %s', domains)
-            return self.api.url_info(domains, *categories)
+            return domains, self.api.url_info(domains, *categories)
+
+        ready = set()
+
+        def new_results():
+            for domain in list(self.session_result):
+                if domain not in ready:
+                    ready.add(domain)
+                    yield domain, self.session_result[domain]
+
+        executor = get_executor('awis')
+        wait = True
+
+        while domains:
+            misses = list(self.handle_cache(domains, wait=wait))
+            yield from new_results()
+
+            for chunk, tree in executor.as_completed(
+                    request, chunks(CHUNK_SIZE, misses),
+                    key=self.auth[0], limit=self.workers_count):
+                if parse:
+                    parse(self, tree)
+                    self.save_chunk(chunk)
+                else:
+                    self.session_list_of_raw_result.append(tree)
+                    # Chunks in the queue are still ours
+                    self.cache.prolong(self.leases)
+
+                yield from new_results()
+
+            # Other workers may fail: fetch their domains by ourselves
+            domains = self.wait_for_others()
+            wait = False
+            yield from new_results()
+
+    def save_chunk(self, domains):
+        """ Cache results of a parsed chunk and release its domains, so
+        other workers don't wait for the whole session. Leases of chunks in
+        the queue are prolonged by the same round-trip.
+        """
+        items = {d: self.session_result.get(d, MISSING) for d in domains}
+        self.leases.difference_update(domains)
+
+        self.cache.set_many(items, release=domains, prolong=self.leases)
+        self.cached.update(items)
 
-        with ThreadPoolExecutor(self.workers_count) as executor:
-            tasks = [
-                executor.submit(request, chunk, categories)
-                for chunk in chunks(CHUNK_SIZE, self.handle_cache(domains))
-            ]
+    def wait_for_others(self):
+        """ Wait for domains which are being fetched by other workers and put
+        them into the result. Returns domains which others didn't fetch.
+        """
+        deadline = time.time() + self.wait_timeout
+        failed = []
+
+        while self.waiting and time.time() < deadline:
+            time.sleep(self.wait_interval)
+
+            cached = self.cache.get_many(self.waiting)
+            self.put_cached(cached)
+            self.waiting.difference_update(cached)
+
+            # Others make progress, so they are given more time
+            if cached:
+                deadline = time.time() + self.wait_timeout
+
+            locked = self.cache.locked(self.waiting)
+            failed.extend(self.waiting - locked)
+            self.waiting = locked
 
-            for future in as_completed(tasks):
-                self.session_list_of_raw_result.append(future.result())
+        if self.waiting:
+            logger.warning('Domains are not fetched by other workers in '
+                           '%s seconds: %s', self.wait_timeout, self.waiting)
+            failed.extend(self.waiting)
+            self.waiting.clear()
+
+        return failed
 
     def get_value(self, root, path, default=None):
         """ Shortcut for fetching first node.
@@ -61,11 +176,12 @@ class AWISContextManager:
         path = self.handle_path(path)
         return getattr(root.find(path, self.api.NS_PREFIXES), 'text', default)
 
-    def iter_results(self, path):
+    def iter_results(self, path, *trees):
         """ Iterator for filling results for a particular domain.
+        Walks given trees or all kept ones.
         """
         path = self.handle_path(path)
-        for tree in self.session_list_of_raw_result:
+        for tree in trees or self.session_list_of_raw_result:
             for node in tree.findall(path, self.api.NS_PREFIXES):
                 domain = self.get_value(node, 'DataUrl')
                 result_row = self.session_result.setdefault(
@@ -74,44 +190,471 @@ class AWISContextManager:
                 yield domain, node, result_row
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def handle_path(path):
-        # TODO: compile reg-exp?
         return './/awis:%s' % (path.strip('.//').strip('/')
                                .replace('/', '/awis:'))
 
-    def handle_cache(self, domains):
+    def put_cached(self, cached):
+        """ Put cached values into the result. Domains without data in the
+        AWIS are skipped.
+        """
+        self.cached.update(cached)
+
+        for d, value in cached.items():
+            if value is not MISSING:
+                self.session_result[d] = value
+
+    def handle_cache(self, domains, wait=True):
         """ Filter domains which already in cache and put them into the result.
+        Only one worker at a time fetches a domain: the rest wait for it.
+        Without ``wait`` domains of other workers are fetched as well.
         """
-        for d in domains:
-            cached_value = self.cache.get(d)
+        domains = list(domains)
+
+        cached, stale = {}, []
+        if not self.refresh:
+            cached, stale = self.cache.get_many_with_stale(domains)
+            self.put_cached(cached)
+
+        # Stale values are used as is, but a refresh is scheduled once
+        stale = self.cache.acquire_refresh(stale)
+        if stale and self.on_stale:
+            self.on_stale(sorted(stale))
 
-            if cached_value:
-                self.session_result[d] = cached_value
+        misses = [d for d in domains if d not in cached]
+        self.leases.update(
+            self.cache.acquire_many(d for d in misses if d not in self.leases))
+
+        for d in misses:
+            if d not in self.leases and wait:
+                logger.debug('Domain %s is being fetched by other worker', d)
+                self.waiting.add(d)
                 continue
 
             yield d
 
 
+class Field(namedtuple('Field', 'name path default type many node')):
+    """ Named value of a node. ``path`` is relative (like in ``get_value``),
+    ``type`` converts the text (or the element itself with ``node``).
+    ``many`` fields collect all found values.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, path, default=None, type=None, many=False,
+                node=False):
+        return super().__new__(cls, name, path, default, type, many, node)
+
+    def convert(self, element):
+        value = element if self.node else element.text
+
+        if self.type is None or value is None:
+            return value
+
+        return self.type(value)
+
+
+class Extractor:
+    """ Compiled set of fields which are fetched from a node in one walk
+    over its descendants instead of a ``find`` per field.
+    """
+    def __init__(self, *fields):
+        self.fields = fields
+        self.paths = defaultdict(list)
+
+        for field in fields:
+            tags = tuple(field.path.strip('/').split('/'))
+            self.paths[tags].append(field)
+
+        self.lengths = sorted({len(tags) for tags in self.paths})
+
+    def __call__(self, node):
+        result = {field.name: [] if field.many else field.default
+                  for field in self.fields}
+        self.walk(node, [], result, set())
+        return result
+
+    def walk(self, node, tags, result, found):
+        for element in node:
+            tags.append(element.tag.rpartition('}')[2])
+
+            for length in self.lengths:
+                if length > len(tags):
+                    break
+
+                for field in self.paths.get(tuple(tags[-length:]), ()):
+                    if field.many:
+                        if element.text or field.node:
+                            result[field.name].append(field.convert(element))
+                    elif field.name not in found:
+                        found.add(field.name)
+                        result[field.name] = field.convert(element)
+
+            self.walk(element, tags, result, found)
+            tags.pop()
+
+
+class _Missing:
+    def __repr__(self):
+        return 'MISSING'
+
+
+# Cached value for domains which the AWIS has no data for
+MISSING = _Missing()
+
+
 class Cache:
     key_tmpl = 'AWIS:cache:%s'
+    missing_data = b'\x00'
+    lease_key_tmpl = 'AWIS:lease:%s'
 
-    def __init__(self):
+    # KEYS - leases; ARGV[1] - owner of leases
+    RELEASE_SCRIPT = """
+        for _, key in ipairs(KEYS) do
+            if redis.call('GET', key) == ARGV[1] then
+                redis.call('DEL', key)
+            end
+        end
+    """
+
+    # KEYS - leases; ARGV[1] - owner of leases; ARGV[2] - expire
+    PROLONG_SCRIPT = """
+        for _, key in ipairs(KEYS) do
+            if redis.call('GET', key) == ARGV[1] then
+                redis.call('EXPIRE', key, ARGV[2])
+            end
+        end
+    """
+
+    refresh_key_tmpl = 'AWIS:refresh:%s'
+
+    def __init__(self, local=None, serializer=None):
         self.redis = Redis(connection_pool=redis_pool)
+        self.serializer = serializer or SERIALIZERS[
+            app.config['AWIS_CACHE_SERIALIZER']]
+        # After ``default_expire`` a value is stale: it is still used but
+        # should be refreshed. After ``hard_expire`` it is removed.
         self.default_expire = 60 * 60 * 24 * 7  # 7 days
+        self.hard_expire = max(app.config['AWIS_CACHE_HARD_EXPIRE'],
+                               self.default_expire)
+        self.missing_expire = app.config['AWIS_MISSING_CACHE_EXPIRE']
+        self.lease_expire = app.config['AWIS_LEASE_EXPIRE']
+        self.refresh_expire = 60 * 60
+        self.local = local if local is not None else get_local_cache(
+            min(self.default_expire, self.missing_expire))
+        self.owner = uuid.uuid4().hex
+        self._release = self.redis.register_script(self.RELEASE_SCRIPT)
+        self._prolong = self.redis.register_script(self.PROLONG_SCRIPT)
 
     def get_key(self, domain):
         return self.key_tmpl % domain
 
-    def get(self, domain):
-        key = self.get_key(domain)
-        value = self.redis.get(key)
+    def get_lease_key(self, domain):
+        return self.lease_key_tmpl % domain
 
-        if value:
-            logger.debug('Domain %s found in cache', domain)
-            value = json.loads(value.decode('utf-8'))
+    def acquire_many(self, domains):
+        """ Take the exclusive right to fetch domains for a while.
+        Returns a set of domains which have been acquired.
+        """
+        domains = list(domains)
+        pipe = self.redis.pipeline(transaction=False)
+
+        for d in domains:
+            pipe.set(self.get_lease_key(d), self.owner,
+                     ex=self.lease_expire, nx=True)
+
+        return set(d for d, ok in zip(domains, pipe.execute()) if ok)
+
+    def acquire_refresh(self, domains):
+        """ Returns domains which nobody has scheduled a refresh for yet.
+        """
+        domains = list(domains)
+        pipe = self.redis.pipeline(transaction=False)
+
+        for d in domains:
+            pipe.set(self.refresh_key_tmpl % d, 1,
+                     ex=self.refresh_expire, nx=True)
+
+        return set(d for d, ok in zip(domains, pipe.execute()) if ok)
 
-        return value
+    def locked(self, domains):
+        """ Returns a set of domains which are being fetched by someone.
+        """
+        domains = list(domains)
+        pipe = self.redis.pipeline(transaction=False)
+
+        for d in domains:
+            pipe.exists(self.get_lease_key(d))
+
+        return set(d for d, ok in zip(domains, pipe.execute()) if ok)
+
+    def release(self, domains, client=None):
+        if domains:
+            self._release(keys=[self.get_lease_key(d) for d in domains],
+                          args=[self.owner], client=client)
+
+    def prolong(self, domains, client=None):
+        """ Keep leases of domains for ``lease_expire`` more seconds.
+        """
+        if domains:
+            self._prolong(keys=[self.get_lease_key(d) for d in domains],
+                          args=[self.owner, self.lease_expire], client=client)
+
+    def get(self, domain):
+        return self.get_many([domain]).get(domain)
 
     def set(self, domain, value):
-        key = self.get_key(domain)
-        self.redis.set(key, json.dumps(value), ex=self.default_expire)
+        self.set_many({domain: value})
+
+    def get_many(self, domains):
+        """ Fetch values for domains by one MGET. Returns a dict of found ones.
+        """
+        return self.get_many_with_stale(domains)[0]
+
+    def get_many_with_stale(self, domains):
+        """ The same as ``get_many`` but also returns a list of found domains
+        which values are stale.
+        """
+        domains = list(domains)
+        result = self.local.get_many(domains) if self.local else {}
+        domains = [d for d in domains if d not in result]
+
+        if not domains:
+            return result, []
+
+        keys = [self.get_key(d) for d in domains]
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.mget(keys)
+        for key in keys:
+            pipe.ttl(key)
+        values, *ttls = pipe.execute()
+
+        found, stale = {}, []
+        # Fresh values are kept locally until they become stale
+        fresh, expires = {}, {}
+        max_stale_ttl = self.hard_expire - self.default_expire
+
+        for d, value, ttl in zip(domains, values, ttls):
+            if not value:
+                continue
+
+            logger.debug('Domain %s found in cache', d)
+            found[d] = self.loads(value)
+
+            # Entries written before versioning live 7 days at most, they
+            # are fresh until they expire
+            if is_legacy(value):
+                if ttl is not None and ttl >= 0:
+                    expires[d] = ttl
+            elif found[d] is not MISSING and ttl is not None and ttl >= 0:
+                if ttl < max_stale_ttl:
+                    stale.append(d)
+                    continue
+
+                expires[d] = ttl - max_stale_ttl
+
+            fresh[d] = found[d]
+
+        if self.local:
+            self.local.set_many(fresh, expires)
+
+        result.update(found)
+        return result, stale
+
+    def set_many(self, items, release=(), prolong=()):
+        """ Save values of given dict ({domain: value}) in one round-trip.
+        ``MISSING`` values are kept for a shorter time.
+        Leases of ``release`` (after the values are saved) and ``prolong``
+        are handled by the same round-trip.
+        """
+        if not items and not release and not prolong:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+
+        for d, value in items.items():
+            if value is MISSING:
+                pipe.set(self.get_key(d), self.missing_data,
+                         ex=self.missing_expire)
+            else:
+                pipe.set(self.get_key(d), self.dumps(value),
+                         ex=self.hard_expire)
+
+        self.release(release, client=pipe)
+        self.prolong(prolong, client=pipe)
+        pipe.execute()
+
+        if self.local:
+            self.local.set_many(items)
+
+    def dumps(self, value):
+        return self.serializer.dumps(value)
+
+    @classmethod
+    def loads(cls, value):
+        """ Values are decoded by the serializer they were written with.
+        """
+        if value == cls.missing_data:
+            return MISSING
+
+        return get_serializer(value).loads(value)
+
+
+class LegacyJSONSerializer:
+    """ The original format: plain JSON without a header. Only read.
+    """
+    name = 'legacy-json'
+    version = None
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+class JSONSerializer:
+    """ JSON prefixed by the version byte.
+    """
+    name = 'json'
+    version = b'\x02'
+
+    def dumps(self, value):
+        return self.version + json.dumps(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data[1:].decode('utf-8'))
+
+
+class MsgpackSerializer:
+    """ MessagePack prefixed by the version byte.
+    """
+    name = 'msgpack'
+    version = b'\x01'
+
+    def dumps(self, value):
+        return self.version + msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data[1:], raw=False)
+
+
+SERIALIZERS = {s.name: s for s in (JSONSerializer(), MsgpackSerializer())}
+LEGACY_SERIALIZER = LegacyJSONSerializer()
+_SERIALIZERS_BY_VERSION = {s.version: s for s in SERIALIZERS.values()}
+
+
+def get_serializer(data):
+    """ Detect a serializer of cached data by its first byte. JSON written
+    before versioning has no header.
+    """
+    return _SERIALIZERS_BY_VERSION.get(data[:1], LEGACY_SERIALIZER)
+
+
+def is_legacy(data):
+    """ Whether cached data is written before versioning.
+    """
+    return data != Cache.missing_data and \
+        get_serializer(data) is LEGACY_SERIALIZER
+
+
+def benchmark_serializers(value, number=10000):
+    """ Compare size and speed of serializers on the given value.
+    """
+    result = {}
+
+    for name, serializer in sorted(SERIALIZERS.items()):
+        data = serializer.dumps(value)
+        result[name] = {
+            'size': len(data),
+            'dumps_us': timeit.timeit(
+                lambda: serializer.dumps(value), number=number
+            ) / number * 10 ** 6,
+            'loads_us': timeit.timeit(
+                lambda: serializer.loads(data), number=number
+            ) / number * 10 ** 6,
+        }
+
+    return result
+
+
+class LocalCache:
+    """ Bounded in-process LRU with TTL. Used by ``Cache`` in front of Redis,
+    so repeated domains within a worker are not fetched and decoded again.
+    """
+    def __init__(self, size, expire):
+        self.size = size
+        self.expire = expire
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        result = {}
+        now = time.time()
+
+        with self.lock:
+            for key in keys:
+                item = self.items.get(key)
+
+                if item is None or item[0] < now:
+                    self.items.pop(key, None)
+                    self.misses += 1
+                    continue
+
+                self.items.move_to_end(key)
+                self.hits += 1
+                # Callers are free to change their copy
+                result[key] = copy_value(item[1])
+
+        return result
+
+    def set_many(self, items, expires=None):
+        """ ``expires`` ({key: seconds}) shortens the time of some items.
+        """
+        now = time.time()
+        expire_at = now + self.expire
+        expires = expires or {}
+
+        with self.lock:
+            for key, value in items.items():
+                if key in expires:
+                    item_expire_at = min(expire_at, now + expires[key])
+                else:
+                    item_expire_at = expire_at
+
+                self.items[key] = (item_expire_at, copy_value(value))
+                self.items.move_to_end(key)
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    @property
+    def stats(self):
+        return {'size': len(self.items), 'hits': self.hits,
+                'misses': self.misses}
+
+
+def copy_value(value):
+    return dict(value) if isinstance(value, dict) else value
+
+
+_local_cache = None
+
+
+def get_local_cache(max_expire):
+    """ The in-process tier of the cache (or None if it is disabled).
+    """
+    global _local_cache
+
+    if _local_cache is None and app.config['AWIS_LOCAL_CACHE_SIZE'] > 0:
+        _local_cache = LocalCache(
+            app.config['AWIS_LOCAL_CACHE_SIZE'],
+            min(app.config['AWIS_LOCAL_CACHE_EXPIRE'], max_expire))
+
+    return _local_cache
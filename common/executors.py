@@ -0,0 +1,138 @@
+import os
+import atexit
+import logging
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from celery.signals import worker_process_shutdown
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedExecutor:
+    """ Thread pool which lives as long as the process and is shared by all
+    clients of a kind. Each client (e.g. a project) is capped by its own
+    limit of tasks in flight, so one of them can't take the whole pool.
+    """
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers,
+                                           thread_name_prefix=name)
+        self.limits = {}
+        self.lock = Lock()
+
+    def get_limit(self, key, size):
+        """ Semaphore of the key. Its size is set by the first caller.
+        """
+        with self.lock:
+            if key not in self.limits:
+                self.limits[key] = BoundedSemaphore(size)
+
+        return self.limits[key]
+
+    def submit(self, fn, *args, key=None, limit=None, **kwargs):
+        """ The same as ``Executor.submit``. With ``key`` and ``limit`` blocks
+        while the key has ``limit`` tasks in flight.
+        """
+        if key is None or not limit:
+            return self.executor.submit(fn, *args, **kwargs)
+
+        semaphore = self.get_limit(key, limit)
+        semaphore.acquire()
+
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            semaphore.release()
+            raise
+
+        future.add_done_callback(lambda _: semaphore.release())
+        return future
+
+    def map(self, fn, iterable, key=None, limit=None):
+        """ The same as ``Executor.map`` for one iterable. Tasks which are
+        not started yet are cancelled if the caller stops on an error.
+        """
+        futures = [self.submit(fn, item, key=key, limit=limit)
+                   for item in iterable]
+
+        def results():
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return results()
+
+    def as_completed(self, fn, iterable, key=None, limit=None):
+        """ Yields results of ``fn`` over ``iterable`` as they are ready.
+        Not more than ``limit`` tasks are submitted at once, the next ones
+        are submitted when previous are completed.
+        """
+        items = iter(iterable)
+        pending = set()
+
+        try:
+            while True:
+                for item in items:
+                    pending.add(self.submit(fn, item, key=key, limit=limit))
+                    if limit and len(pending) >= limit:
+                        break
+
+                if not pending:
+                    return
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_executors = {}
+_pid = None
+_lock = Lock()
+
+
+def get_executor(name):
+    """ Returns the executor of the process for the kind of work.
+    Its size is ``<NAME>_EXECUTOR_SIZE`` from the config. Executors are
+    created lazily, so forked workers don't inherit pools of the parent.
+    """
+    global _pid
+    from app import app
+
+    with _lock:
+        if _pid != os.getpid():
+            _executors.clear()
+            _pid = os.getpid()
+
+        if name not in _executors:
+            size = app.config['%s_EXECUTOR_SIZE' % name.upper()]
+            _executors[name] = SharedExecutor(name, size)
+            logger.debug('Executor %s of %s threads is created', name, size)
+
+    return _executors[name]
+
+
+def shutdown_executors(**kwargs):
+    with _lock:
+        if _pid != os.getpid():
+            return
+
+        for executor in _executors.values():
+            executor.shutdown(wait=False)
+
+        _executors.clear()
+
+
+atexit.register(shutdown_executors)
+worker_process_shutdown.connect(shutdown_executors)
@@ -7,6 +7,7 @@ from app import db
 
 post_save = signal('post_save')
 pre_delete = signal('pre_delete')
+post_delete = signal('post_delete')
 
 
 class PrimaryKeyMixin(object):
@@ -33,6 +34,7 @@ class BaseModelMixin(PrimaryKeyMixin):
         pre_delete.send(self.class_name, instance=self)
         db.session.delete(self)
         db.session.commit()
+        post_delete.send(self.class_name, instance=self)
 
     @classmethod
     def get_or_404(cls, *args):
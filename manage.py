@@ -11,5 +11,30 @@ def runserver():
     app.run(host='0.0.0.0', port=8000)
 
 
+@manager.command
+def benchmark_awis_cache(number=10000):
+    """ Compare serializers of the AWIS cache (size and time).
+    """
+    from common.awis import benchmark_serializers
+
+    value = {
+        'lang': 'en',
+        'country_rank': 1532,
+        'rank_value': '20671',
+        'per_million': '61',
+        'page_views_per_million': '1.7',
+        'site_data': {
+            'title': 'Uploadcare',
+            'description': 'File uploads and processing for developers',
+            'online_since': '25-Mar-2011',
+        },
+    }
+
+    results = benchmark_serializers(value, int(number))
+    for name, r in results.items():
+        print('{0:>8}: {1[size]:>4} bytes, dumps {1[dumps_us]:.2f} us, '
+              'loads {1[loads_us]:.2f} us'.format(name, r))
+
+
 if __name__ == "__main__":
     manager.run()
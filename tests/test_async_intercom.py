@@ -0,0 +1,137 @@
+import asyncio
+import threading
+
+import aiohttp
+import mock
+import requests
+
+from tests.base import TestCase
+from app.intercom.async_service import (AsyncIntercomClient,
+                                        SyncIntercomClient, get_loop)
+
+
+class FakeResponse:
+    def __init__(self, data, headers=None):
+        self.data = data
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self, content_type=None):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return self.responses.pop(0)
+
+
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+class AsyncIntercomClientTestCase(TestCase):
+    def test_blocking_calls_out_of_loop(self):
+        threads = []
+
+        def record(*args):
+            threads.append(threading.current_thread().name)
+            return 0
+
+        limiter = mock.Mock()
+        limiter.reserve.side_effect = record
+        limiter.update.side_effect = record
+
+        client = AsyncIntercomClient('app_id', 'api_key',
+                                     rate_limiter=limiter)
+        session = FakeSession(FakeResponse({'id': 1}))
+
+        with mock.patch.object(AsyncIntercomClient, 'session', session):
+            self.assertEqual({'id': 1}, run(client.request('GET', 'url')))
+
+        self.assertEqual(2, len(threads))
+        self.assertNotIn('intercom-event-loop', threads)
+
+    def test_session_is_closed_by_last_user(self):
+        client = AsyncIntercomClient('app_id', 'api_key')
+
+        async def use():
+            async with client:
+                async with client:
+                    session = client.session
+                self.assertFalse(session.closed)
+            return session
+
+        session = run(use())
+        self.assertTrue(session.closed)
+        self.assertIsNone(client._session)
+
+
+class SyncIntercomClientTestCase(TestCase):
+    def setUp(self):
+        super(SyncIntercomClientTestCase, self).setUp()
+        self.client = SyncIntercomClient('app_id', 'api_key')
+        self.sessions = []
+
+    def fake_request(self, *responses):
+        responses = list(responses)
+
+        async def request(method, url, **kwargs):
+            self.sessions.append(self.client.client.session)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        return mock.patch.object(self.client.client, 'request', request)
+
+    def test_session_is_closed_after_call(self):
+        with self.fake_request({'id': 'some-id'}):
+            result = self.client.subscribe('http://hook.url/',
+                                           ['user.created'])
+
+        self.assertEqual({'id': 'some-id'}, result)
+        self.assertTrue(self.sessions[0].closed)
+
+    def test_session_is_closed_after_pages(self):
+        pages = [
+            {'users': [{'user_id': 1}], 'pages': {'next': 'http://next/'}},
+            {'users': [{'user_id': 2}], 'pages': {'next': None}},
+        ]
+
+        with self.fake_request(*pages):
+            users = list(self.client.iter_users())
+
+        self.assertEqual([{'user_id': 1}, {'user_id': 2}], users)
+        self.assertIs(self.sessions[0], self.sessions[1])
+        self.assertTrue(self.sessions[0].closed)
+
+    def test_errors_of_requests(self):
+        error = aiohttp.ClientResponseError(None, (), status=429,
+                                            message='Too Many Requests')
+
+        with self.fake_request(error):
+            with self.assertRaises(requests.HTTPError) as context:
+                self.client.unsubscribe('some-id')
+
+        self.assertEqual(429, context.exception.response.status_code)
+
+        with self.fake_request(asyncio.TimeoutError()):
+            self.assertRaises(requests.exceptions.ReadTimeout,
+                              self.client.unsubscribe, 'some-id')
+
+        with self.fake_request(aiohttp.ServerDisconnectedError()):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              self.client.unsubscribe, 'some-id')
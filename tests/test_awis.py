@@ -0,0 +1,446 @@
+import json
+import time
+import collections
+import threading
+
+import mock
+
+from tests.base import TestCase
+from common.awis import (AWISContextManager, LocalCache, Cache, SERIALIZERS,
+                         MISSING, Extractor, Field)
+
+
+class LocalCacheTestCase(TestCase):
+    def test_get_and_set(self):
+        cache = LocalCache(size=10, expire=60)
+        cache.set_many({'a.com': {'rank': 1}})
+
+        self.assertEqual({'a.com': {'rank': 1}},
+                         cache.get_many(['a.com', 'b.com']))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1}, cache.stats)
+
+    def test_values_are_copied(self):
+        cache = LocalCache(size=10, expire=60)
+        cache.set_many({'a.com': {'rank': 1}})
+
+        cache.get_many(['a.com'])['a.com']['rank'] = 2
+        self.assertEqual({'rank': 1}, cache.get_many(['a.com'])['a.com'])
+
+    def test_size_limit(self):
+        cache = LocalCache(size=2, expire=60)
+        cache.set_many({'a.com': {}, 'b.com': {}})
+        cache.get_many(['a.com'])
+        cache.set_many({'c.com': {}})
+
+        self.assertEqual(['a.com', 'c.com'],
+                         sorted(cache.get_many(['a.com', 'b.com', 'c.com'])))
+
+    @mock.patch('common.awis.time')
+    def test_expire(self, time):
+        time.time.return_value = 100
+        cache = LocalCache(size=10, expire=60)
+        cache.set_many({'a.com': {}})
+
+        time.time.return_value = 161
+        self.assertEqual({}, cache.get_many(['a.com']))
+        self.assertEqual(0, cache.stats['size'])
+
+    @mock.patch('common.awis.time')
+    def test_expire_of_item(self, time):
+        time.time.return_value = 100
+        cache = LocalCache(size=10, expire=60)
+        cache.set_many({'a.com': {}, 'b.com': {}}, {'a.com': 10})
+
+        time.time.return_value = 111
+        self.assertEqual({'b.com': {}}, cache.get_many(['a.com', 'b.com']))
+
+
+class SerializersTestCase(TestCase):
+    value = {'lang': 'en', 'country_rank': 10, 'rank_value': '100',
+             'site_data': {'title': 'Title'}}
+
+    def test_round_trip(self):
+        for serializer in SERIALIZERS.values():
+            data = serializer.dumps(self.value)
+            self.assertEqual(self.value, Cache.loads(data))
+
+    def test_legacy_json(self):
+        data = json.dumps(self.value).encode('utf-8')
+        self.assertEqual(self.value, Cache.loads(data))
+
+    def test_msgpack_is_versioned(self):
+        data = SERIALIZERS['msgpack'].dumps(self.value)
+        self.assertEqual(b'\x01', data[:1])
+
+    def test_json_is_versioned(self):
+        data = SERIALIZERS['json'].dumps(self.value)
+        self.assertEqual(b'\x02', data[:1])
+
+    def test_missing(self):
+        self.assertIs(MISSING, Cache.loads(Cache.missing_data))
+
+
+class ExtractorTestCase(TestCase):
+    XML = '''
+        <aws:TrafficData xmlns:aws="http://awis.amazonaws.com/doc/2005-07-11">
+          <aws:DataUrl>a.com</aws:DataUrl>
+          <aws:Rank>10</aws:Rank>
+          <aws:RankByCountry>
+            <aws:Country Code="US"><aws:Rank>5</aws:Rank></aws:Country>
+            <aws:Country Code="O"><aws:Rank/></aws:Country>
+          </aws:RankByCountry>
+          <aws:Reach><aws:Rank><aws:Value>7</aws:Value></aws:Rank></aws:Reach>
+        </aws:TrafficData>
+    '''
+
+    def test_extract(self):
+        from xml.etree import ElementTree
+
+        extract = Extractor(
+            Field('rank', 'Rank', type=int),
+            Field('ranks', 'Country/Rank', many=True, type=int),
+            Field('reach', 'Reach/Rank/Value'),
+            Field('title', 'SiteData/Title', default='-'),
+        )
+
+        self.assertEqual(
+            {'rank': 10, 'ranks': [5], 'reach': '7', 'title': '-'},
+            extract(ElementTree.fromstring(self.XML)))
+
+
+def fake_parse(awis, tree):
+    """ Trees of the fake AWIS are lists of requested domains.
+    """
+    for domain in tree:
+        if not domain.startswith('missing'):
+            awis.session_result[domain] = {'rank': len(domain)}
+
+
+class AWISTestCase(TestCase):
+    domains = ['a.test', 'bb.test', 'ccc.test', 'dddd.test', 'eeeee.test',
+               'ffffff.test', 'missing.test']
+
+    def setUp(self):
+        super(AWISTestCase, self).setUp()
+        patcher = mock.patch('common.awis.get_local_cache', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = Cache()
+        self.clean()
+
+        patcher = mock.patch('common.awis.AwisApi')
+        self.api = patcher.start().return_value
+        self.api.url_info.side_effect = lambda domains, *args: list(domains)
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.clean()
+        super(AWISTestCase, self).tearDown()
+
+    def clean(self):
+        self.cache.redis.delete(*[
+            tmpl % d for d in self.domains
+            for tmpl in (Cache.key_tmpl, Cache.lease_key_tmpl,
+                         Cache.refresh_key_tmpl)])
+
+    def start_session(self):
+        awis = AWISContextManager('id', 'secret', workers_count=1)
+        awis.wait_interval = 0.01
+        return awis
+
+
+class CacheTestCase(AWISTestCase):
+    def test_get_many(self):
+        self.cache.set_many({'a.test': {'rank': 1}, 'ccc.test': MISSING})
+
+        result = self.cache.get_many(
+            ['bb.test', 'ccc.test', 'dddd.test', 'a.test'])
+
+        self.assertEqual({'a.test': {'rank': 1}, 'ccc.test': MISSING}, result)
+        self.assertEqual({}, self.cache.get_many([]))
+
+    def test_keys_order(self):
+        self.cache.set_many({d: {'rank': len(d)} for d in self.domains[:3]})
+
+        result = self.cache.get_many(reversed(self.domains))
+        self.assertEqual(['ccc.test', 'bb.test', 'a.test'], list(result))
+        self.assertEqual({d: {'rank': len(d)} for d in self.domains[:3]},
+                         result)
+
+    def test_set_many(self):
+        self.cache.set_many({'a.test': {'rank': 1}, 'bb.test': MISSING})
+
+        ttl = self.cache.redis.ttl
+        self.assertTrue(ttl(self.cache.get_key('a.test')) >
+                        self.cache.default_expire)
+        self.assertTrue(ttl(self.cache.get_key('bb.test')) <=
+                        self.cache.missing_expire)
+        self.assertEqual(Cache.missing_data,
+                         self.cache.redis.get(self.cache.get_key('bb.test')))
+
+
+class StaleTestCase(AWISTestCase):
+    def make_stale(self, domain, in_seconds=-10):
+        """ The value of the domain becomes stale in given seconds.
+        """
+        max_stale_ttl = self.cache.hard_expire - self.cache.default_expire
+        self.cache.redis.expire(self.cache.get_key(domain),
+                                max_stale_ttl + in_seconds)
+
+    def test_stale(self):
+        self.cache.set_many({'a.test': {'rank': 1}, 'bb.test': {'rank': 2},
+                             'ccc.test': MISSING})
+        self.make_stale('a.test')
+
+        self.assertEqual(
+            ({'a.test': {'rank': 1}, 'bb.test': {'rank': 2},
+              'ccc.test': MISSING}, ['a.test']),
+            self.cache.get_many_with_stale(['a.test', 'bb.test', 'ccc.test']))
+
+    def test_legacy_entry_is_fresh(self):
+        cache = Cache(local=LocalCache(size=10, expire=3600))
+        # Written before versioning: plain JSON for up to 7 days
+        self.cache.redis.set(self.cache.get_key('a.test'),
+                             json.dumps({'rank': 1}), ex=60)
+
+        self.assertEqual(({'a.test': {'rank': 1}}, []),
+                         cache.get_many_with_stale(['a.test']))
+        self.assertTrue(cache.local.items['a.test'][0] <= time.time() + 60)
+
+    def test_local_hit_becomes_stale(self):
+        cache = Cache(local=LocalCache(size=10, expire=3600))
+        self.cache.set_many({'a.test': {'rank': 1}, 'bb.test': {'rank': 2}})
+        self.make_stale('a.test')
+        self.make_stale('bb.test', in_seconds=5)
+
+        cache.get_many(['a.test', 'bb.test'])
+
+        # Stale values are not kept locally, others until they become stale
+        self.assertEqual(['bb.test'], list(cache.local.items))
+        self.assertTrue(cache.local.items['bb.test'][0] <= time.time() + 5)
+        self.assertEqual(['a.test'],
+                         cache.get_many_with_stale(['a.test', 'bb.test'])[1])
+
+    def test_acquire_refresh(self):
+        self.assertEqual({'a.test', 'bb.test'},
+                         self.cache.acquire_refresh(['a.test', 'bb.test']))
+        self.assertEqual({'ccc.test'},
+                         Cache().acquire_refresh(['bb.test', 'ccc.test']))
+
+    def test_on_stale(self):
+        self.cache.set_many({'a.test': {'rank': 1}})
+        self.make_stale('a.test')
+        on_stale = mock.Mock()
+
+        for _ in range(2):
+            awis = AWISContextManager('id', 'secret', on_stale=on_stale)
+            with awis:
+                awis.url_info(['a.test'], parse=fake_parse)
+
+            # The stale value is used as is
+            self.assertEqual({'a.test': {'rank': 1}}, awis.session_result)
+
+        # Refresh is scheduled once
+        on_stale.assert_called_once_with(['a.test'])
+        self.assertFalse(self.api.url_info.called)
+
+    def test_refresh(self):
+        self.cache.set_many({'a.test': {'rank': 1}})
+
+        awis = AWISContextManager('id', 'secret', refresh=True)
+        with awis:
+            awis.url_info(['a.test'], parse=fake_parse)
+
+        self.assertEqual({'a.test': {'rank': 6}}, awis.session_result)
+        self.assertEqual({'rank': 6}, self.cache.get('a.test'))
+
+
+class LeasesTestCase(AWISTestCase):
+    def test_acquire_and_release(self):
+        other = Cache()
+
+        self.assertEqual({'a.test'}, self.cache.acquire_many(['a.test']))
+        # Only free domains are acquired
+        self.assertEqual({'bb.test'},
+                         other.acquire_many(['a.test', 'bb.test']))
+        self.assertEqual(set(), self.cache.acquire_many(['bb.test']))
+        self.assertEqual({'a.test', 'bb.test'},
+                         self.cache.locked(['a.test', 'bb.test', 'ccc.test']))
+
+        # Only the owner can release a lease
+        other.release(['a.test', 'bb.test'])
+        self.assertEqual({'a.test'}, self.cache.locked(['a.test', 'bb.test']))
+
+        self.cache.release(['a.test'])
+        self.assertEqual(set(), self.cache.locked(['a.test']))
+
+    def test_prolong(self):
+        other = Cache()
+        self.cache.acquire_many(['a.test'])
+        other.acquire_many(['bb.test'])
+
+        self.cache.lease_expire = 1000
+        self.cache.prolong(['a.test', 'bb.test'])
+
+        def ttl(domain):
+            return self.cache.redis.ttl(self.cache.get_lease_key(domain))
+
+        self.assertTrue(ttl('a.test') > 60)
+        self.assertTrue(ttl('bb.test') <= 60)
+
+
+class AWISContextManagerTestCase(AWISTestCase):
+    def test_chunks_are_cached_and_released(self):
+        first, second = self.domains[:5], self.domains[5:]
+
+        with self.start_session() as awis:
+            results = awis.iter_url_info(self.domains, parse=fake_parse)
+            self.assertEqual(('a.test', {'rank': 6}), next(results))
+
+            # The first chunk is available to others at once
+            self.assertEqual(set(first), set(self.cache.get_many(first)))
+            self.assertEqual(set(), self.cache.locked(first))
+            self.assertEqual(set(second), self.cache.locked(second))
+
+            list(results)
+            self.assertEqual(set(), awis.leases)
+
+        self.assertEqual(set(), self.cache.locked(self.domains))
+        self.assertIs(MISSING, self.cache.get('missing.test'))
+        self.assertEqual({'rank': 11}, self.cache.get('ffffff.test'))
+
+    def test_parse_per_chunk(self):
+        parse = mock.Mock(side_effect=fake_parse)
+        self.cache.set_many({'dddd.test': {'rank': 0}})
+
+        with self.start_session() as awis:
+            results = list(awis.iter_url_info(self.domains, parse=parse))
+
+        self.assertEqual(
+            [mock.call(awis, ['a.test', 'bb.test', 'ccc.test', 'eeeee.test',
+                              'ffffff.test']),
+             mock.call(awis, ['missing.test'])],
+            parse.call_args_list)
+        # Cached ones first, the rest by chunks
+        self.assertEqual(
+            [('dddd.test', {'rank': 0}), ('a.test', {'rank': 6}),
+             ('bb.test', {'rank': 7}), ('ccc.test', {'rank': 8}),
+             ('eeeee.test', {'rank': 10}), ('ffffff.test', {'rank': 11})],
+            results)
+
+    def test_one_round_trip_per_chunk(self):
+        calls = []
+
+        def record(method):
+            def wrapper(domains, client=None):
+                calls.append((method.__name__, sorted(domains), client))
+                return method(domains, client=client)
+            return wrapper
+
+        with self.start_session() as awis:
+            cache = awis.cache
+            with mock.patch.object(cache, 'release', record(cache.release)), \
+                    mock.patch.object(cache, 'prolong', record(cache.prolong)):
+                awis.url_info(self.domains, parse=fake_parse)
+
+        # Leases are handled by pipelines which save values of chunks
+        self.assertEqual([
+            ('release', self.domains[:5]),
+            ('prolong', ['ffffff.test', 'missing.test']),
+            ('release', ['ffffff.test', 'missing.test']), ('prolong', []),
+        ], [c[:2] for c in calls[:4]])
+        self.assertTrue(all(c[2] is not None for c in calls[:4]))
+
+    def test_wait_for_other_owner(self):
+        other = Cache()
+        self.assertEqual({'a.test'}, other.acquire_many(['a.test']))
+
+        def fetched():
+            other.set_many({'a.test': {'rank': 0}})
+            other.release(['a.test'])
+
+        timer = threading.Timer(0.1, fetched)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        with self.start_session() as awis:
+            awis.url_info(['a.test', 'bb.test'], parse=fake_parse)
+
+        self.assertEqual({'a.test': {'rank': 0}, 'bb.test': {'rank': 7}},
+                         awis.session_result)
+        self.api.url_info.assert_called_once_with(['bb.test'])
+
+    def test_wait_timeout(self):
+        other = Cache()
+        other.acquire_many(['a.test'])
+
+        with self.start_session() as awis:
+            awis.wait_timeout = 0.1
+            awis.url_info(['a.test', 'bb.test'], parse=fake_parse)
+
+        self.assertEqual({'a.test': {'rank': 6}, 'bb.test': {'rank': 7}},
+                         awis.session_result)
+        self.assertEqual([mock.call(['bb.test']), mock.call(['a.test'])],
+                         self.api.url_info.call_args_list)
+        # The lease of the other worker is untouched
+        self.assertEqual({'a.test'}, self.cache.locked(['a.test']))
+
+    def test_exit_caches_missing(self):
+        with self.start_session() as awis:
+            awis.url_info(['a.test', 'missing.test'])
+            self.assertEqual({}, self.cache.get_many(['a.test']))
+            fake_parse(awis, *awis.session_list_of_raw_result)
+
+        self.assertEqual({'a.test': {'rank': 6}, 'missing.test': MISSING},
+                         self.cache.get_many(['a.test', 'missing.test']))
+        self.assertEqual(set(), self.cache.locked(['a.test', 'missing.test']))
+
+    def test_exit_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.start_session() as awis:
+                awis.url_info(['a.test', 'missing.test'])
+                fake_parse(awis, *awis.session_list_of_raw_result)
+                raise ValueError
+
+        self.assertEqual({}, self.cache.get_many(['a.test', 'missing.test']))
+        self.assertEqual(set(), self.cache.locked(['a.test', 'missing.test']))
+
+
+class UpdateInformationTestCase(TestCase):
+    data = {'rank_value': '1', 'site_data': {
+        'title': 'T', 'description': 'D', 'online_since': '-'}}
+
+    @mock.patch('app.accounts.tasks.iter_information')
+    def test_batches(self, iter_information):
+        from app.accounts.tasks import update_information
+
+        events = []
+
+        def fetch(project, domains):
+            for domain in domains:
+                events.append(('awis', domain))
+                yield domain, dict(self.data)
+
+        def send(kind):
+            return lambda items, **kwargs: events.append(
+                (kind, [i['user_id'] for i in items]))
+
+        iter_information.side_effect = fetch
+        project = mock.Mock()
+        intercom = project.get_intercom_client.return_value
+        intercom.update_users.side_effect = send('users')
+        intercom.create_notes.side_effect = send('notes')
+
+        domains_map = collections.OrderedDict([
+            ('a.com', list(range(30))), ('b.com', list(range(30, 90))),
+            ('c.com', [90])])
+        update_information(project, domains_map)
+
+        # The first batch is sent while the rest of domains are fetched
+        self.assertEqual([
+            ('awis', 'a.com'), ('awis', 'b.com'),
+            ('users', list(range(50))), ('notes', list(range(50))),
+            ('awis', 'c.com'),
+            ('users', list(range(50, 91))), ('notes', list(range(50, 91))),
+        ], events)
@@ -0,0 +1,36 @@
+import time
+from threading import Lock
+
+from tests.base import TestCase
+from common.executors import SharedExecutor, get_executor
+
+
+class SharedExecutorTestCase(TestCase):
+    def test_registry(self):
+        self.assertIs(get_executor('awis'), get_executor('awis'))
+        self.assertIsNot(get_executor('awis'), get_executor('intercom'))
+
+    def test_map(self):
+        executor = SharedExecutor('test', 4)
+        result = executor.map(lambda x: x * 2, range(5), key='a', limit=2)
+        self.assertEqual([0, 2, 4, 6, 8], list(result))
+
+    def test_limit(self):
+        executor = SharedExecutor('test', 4)
+        lock = Lock()
+        running = []
+        maximum = []
+
+        def task(x):
+            with lock:
+                running.append(x)
+                maximum.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(x)
+            return x
+
+        result = executor.as_completed(task, range(6), key='a', limit=2)
+
+        self.assertEqual(list(range(6)), sorted(result))
+        self.assertEqual(2, max(maximum))
@@ -1,7 +1,9 @@
+import mock
 from flask import url_for
 
 from tests.base import TestCase
 from app.accounts.models import FreeEmailProvider
+from app.accounts.utils import email_is_useful
 
 
 class FreeEmailProviderTestCase(TestCase):
@@ -53,7 +55,8 @@ class FreeEmailProviderTestCase(TestCase):
         form = self.get_context_variable('form')
         self.assertTrue(form.errors)
 
-    def test_add(self):
+    @mock.patch('app.intercom.models.reclassify_domains')
+    def test_add(self, reclassify_domains):
         self.login()
         domain = 'unique.new.domain'
 
@@ -65,8 +68,10 @@ class FreeEmailProviderTestCase(TestCase):
 
         self.assertTrue(FreeEmailProvider.query.filter(
             FreeEmailProvider.domain == domain).first())
+        reclassify_domains.delay.assert_called_once_with([domain], False)
 
-    def test_remove(self):
+    @mock.patch('app.intercom.models.reclassify_domains')
+    def test_remove(self, reclassify_domains):
         self.login()
         target = self.items[0]
         url = url_for('accounts.free_email_provider_remove', pk=target.id)
@@ -77,4 +82,60 @@ class FreeEmailProviderTestCase(TestCase):
         self.assertEqual(None, FreeEmailProvider.query.filter(
             FreeEmailProvider.domain == target.domain
         ).first())
+        reclassify_domains.delay.assert_called_once_with([target.domain],
+                                                         True)
 
+    @mock.patch('app.intercom.models.reclassify_domains')
+    def test_index_follows_changes(self, reclassify_domains):
+        self.login()
+        domain = 'unique.new.domain'
+        email = 'user@%s' % domain
+
+        self.assertTrue(email_is_useful(email))
+        self.assertFalse(email_is_useful('user@%s' % self.items[0].domain))
+
+        self.client.post(self.url, data={'domain': domain})
+        self.assertFalse(email_is_useful(email))
+
+        target = FreeEmailProvider.query.filter(
+            FreeEmailProvider.domain == domain).first()
+        url = url_for('accounts.free_email_provider_remove', pk=target.id)
+        self.client.post(url)
+        self.assertTrue(email_is_useful(email))
+
+    @mock.patch('app.accounts.utils.reclassify_domains')
+    def test_import(self, reclassify_domains):
+        self.login()
+        url = url_for('accounts.free_email_providers_import')
+        domains = '\n'.join([self.items[0].domain, 'new1.com', ' new2.com',
+                             '', 'new1.com'])
+
+        response = self.client.post(url, data={'domains': domains},
+                                    follow_redirects=True)
+        self.assert200(response)
+
+        self.assertEqual(len(self.items) + 2,
+                         FreeEmailProvider.query.count())
+        reclassify_domains.delay.assert_called_once_with(
+            ['new1.com', 'new2.com'], False)
+        self.assertFalse(email_is_useful('user@new2.com'))
+
+    def test_export(self):
+        self.login()
+        response = self.client.get(
+            url_for('accounts.free_email_providers_export'))
+
+        self.assert200(response)
+        self.assertEqual(sorted(item.domain for item in self.items),
+                         response.data.decode('utf-8').split())
+
+    @mock.patch('app.intercom.models.reclassify_domains')
+    def test_index_is_empty_without_providers(self, reclassify_domains):
+        domain = self.items[0].domain
+        self.assertFalse(email_is_useful('user@%s' % domain))
+
+        for item in self.items:
+            item.delete()
+
+        self.assertTrue(email_is_useful('user@%s' % domain))
+        self.assertEqual(len(self.items), reclassify_domains.delay.call_count)
@@ -0,0 +1,104 @@
+import mock
+from celery.exceptions import Retry
+from requests.exceptions import ReadTimeout
+
+from tests.base import TestCase
+from app.accounts.models import Project
+from app.accounts.tasks import handle_intercom_users
+from app.intercom.models import IntercomUser
+from app.intercom.checkpoint import ImportCheckpoint
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        super(ImportTestCase, self).setUp()
+        self.project = Project(
+            title='title',
+            intercom_app_id='intercom_app_id',
+            intercom_api_key='intercom_api_key',
+            aws_access_id='aws_access_id',
+            aws_secret_access_key='aws_secret_access_key',
+            user_id=self.user.id)
+        self.project.save()
+
+        self.checkpoint = ImportCheckpoint(self.project.id)
+        self.checkpoint.clear()
+
+        patcher = mock.patch.object(Project, 'get_intercom_client')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('app.accounts.tasks.fetch_and_update_domains')
+        self.fetch_and_update_domains = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.checkpoint.clear()
+        super(ImportTestCase, self).tearDown()
+
+    def get_user_ids(self):
+        return sorted(u.user_id for u in IntercomUser.query.filter(
+            IntercomUser.project_id == self.project.id))
+
+    def test_incremental(self):
+        self.project.intercom_users_updated_at = 1000
+        self.project.save()
+
+        # Sorted by updated_at: the second user hasn't changed since
+        self.client.iter_pages.return_value = [
+            ([{'user_id': 2, 'email': 'u2@b.com', 'updated_at': 1100},
+              {'user_id': 1, 'email': 'u1@a.com', 'updated_at': 900}],
+             'http://next/'),
+        ]
+
+        handle_intercom_users(self.project.id)
+
+        self.client.iter_pages.assert_called_once_with(
+            url=None, sort='updated_at')
+        self.assertEqual([2], self.get_user_ids())
+        self.fetch_and_update_domains.delay.assert_called_once_with(
+            ['b.com'], self.project.id)
+
+        project = Project.query.filter(Project.id == self.project.id).first()
+        self.assertEqual(1100, project.intercom_users_updated_at)
+
+    @mock.patch.object(handle_intercom_users, 'retry', side_effect=Retry)
+    def test_resume(self, retry):
+        def first_pages(**kwargs):
+            yield [{'user_id': 1, 'email': 'u1@a.com'}], 'http://page/2'
+            raise ReadTimeout
+
+        self.client.iter_pages.side_effect = first_pages
+        self.assertRaises(Retry, handle_intercom_users, self.project.id)
+        self.assertIsInstance(retry.call_args[1]['exc'], ReadTimeout)
+        self.assertFalse(self.fetch_and_update_domains.delay.called)
+
+        # The retry continues from the failed page
+        self.client.iter_pages.side_effect = None
+        self.client.iter_pages.return_value = [
+            ([{'user_id': 2, 'email': 'u2@b.com'}], None)]
+        handle_intercom_users(self.project.id)
+
+        self.client.iter_pages.assert_called_with(url='http://page/2')
+        self.assertEqual([1, 2], self.get_user_ids())
+        self.fetch_and_update_domains.delay.assert_called_once_with(
+            ['a.com', 'b.com'], self.project.id)
+        self.assertEqual(ImportCheckpoint.initial(), self.checkpoint.load())
+
+    def test_resume_after_last_page(self):
+        IntercomUser(project_id=self.project.id, user_id=1, domain='a.com',
+                     is_useful_domain=True, is_awis_pending=True).save()
+
+        # The last page is synced, but the import failed after that
+        state = ImportCheckpoint.initial()
+        state.update(pages=2, users=1, useful=1, updated_at=1100)
+        self.checkpoint.save(state)
+
+        handle_intercom_users(self.project.id)
+
+        self.assertFalse(self.client.iter_pages.called)
+        self.fetch_and_update_domains.delay.assert_called_once_with(
+            ['a.com'], self.project.id)
+
+        project = Project.query.filter(Project.id == self.project.id).first()
+        self.assertEqual(1100, project.intercom_users_updated_at)
@@ -1,12 +1,20 @@
+import time
 import collections
 
 import mock
 from requests import RequestException
+from sqlalchemy.dialects import postgresql
 from tests.base import TestCase
-from app.intercom.service import IntercomClient, TIMEOUT, RETRY_COUNT
+from app.intercom.service import (IntercomClient, TIMEOUT, RETRY_COUNT,
+                                  get_session, create_session,
+                                  get_pool_stats)
+from app.intercom.ratelimit import RateLimiter, Pacer, get_notes_pacer
+from app.intercom.buffer import HooksBuffer
+from app.intercom.models import IntercomUser
+from app.accounts.models import Project
 
 
-@mock.patch('app.intercom.service.session')
+@mock.patch('app.intercom.service.get_session')
 class IntercomClientTestCase(TestCase):
     def test_init(self, *args):
         client = IntercomClient('app_id', 'api_key', 5)
@@ -24,7 +32,8 @@ class IntercomClientTestCase(TestCase):
         self.assertEqual(headers['Accept'], 'application/json')
         self.assertEqual(headers['X-Extra'], 'Header-Value')
 
-    def test_iter_users(self, session):
+    def test_iter_users(self, get_session):
+        session = get_session.return_value
         client = IntercomClient(app_id='app_id', api_key='api_key')
         pages = 2
 
@@ -76,7 +85,94 @@ class IntercomClientTestCase(TestCase):
             mock.call().json(),
         ])
 
-    def test_iter_users_retry(self, session):
+    def test_iter_pages(self, get_session):
+        session = get_session.return_value
+        client = IntercomClient(app_id='app_id', api_key='api_key')
+
+        response = mock.Mock()
+        response.json.side_effect = [
+            {'users': ['user_one'], 'pages': {'next': 'http://next.url/'}},
+            {'users': ['user_two'], 'pages': {'next': None}},
+        ]
+        session.get.return_value = response
+
+        result = list(client.iter_pages())
+
+        self.assertListEqual([(['user_one'], 'http://next.url/'),
+                              (['user_two'], None)], result)
+        self.assertEqual(session.get.call_count, 2)
+
+    def test_iter_pages_from_url(self, get_session):
+        session = get_session.return_value
+        client = IntercomClient(app_id='app_id', api_key='api_key')
+
+        response = mock.Mock()
+        response.json.return_value = {'users': [], 'pages': {'next': None}}
+        session.get.return_value = response
+
+        list(client.iter_pages(url='http://next.url/'))
+
+        session.get.assert_called_once_with(
+            'http://next.url/', auth=client.auth,
+            headers=client.get_headers(), timeout=TIMEOUT)
+
+    def test_rate_limiter_is_used(self, get_session):
+        session = get_session.return_value
+        limiter = mock.Mock()
+        client = IntercomClient('app_id', 'api_key', rate_limiter=limiter)
+
+        response = mock.Mock()
+        response.json.return_value = {}
+        session.delete.return_value = response
+
+        client.unsubscribe('some-subscription-id')
+
+        self.assertEqual(limiter.acquire.call_count, 1)
+        limiter.update.assert_called_once_with(response.headers)
+
+    def test_iter_pages_sorted(self, get_session):
+        session = get_session.return_value
+        client = IntercomClient(app_id='app_id', api_key='api_key')
+
+        response = mock.Mock()
+        response.json.return_value = {'users': [], 'pages': {'next': None}}
+        session.get.return_value = response
+
+        list(client.iter_pages(sort='updated_at'))
+
+        session.get.assert_called_once_with(
+            'https://api.intercom.io/users?page=1&per_page=50&order=desc'
+            '&sort=updated_at',
+            auth=client.auth, headers=client.get_headers(), timeout=TIMEOUT)
+
+    def test_iter_scroll_pages(self, get_session):
+        session = get_session.return_value
+        client = IntercomClient(app_id='app_id', api_key='api_key')
+
+        response = mock.Mock()
+        response.json.side_effect = [
+            {'users': ['user_one'], 'scroll_param': 'param'},
+            {'users': [], 'scroll_param': 'param'},
+        ]
+        session.get.return_value = response
+
+        result = list(client.iter_scroll_pages())
+
+        scroll_url = 'https://api.intercom.io/users/scroll'
+        self.assertListEqual(
+            [(['user_one'], scroll_url + '?scroll_param=param')], result)
+
+        _common = dict(auth=client.auth, headers=client.get_headers(),
+                       timeout=TIMEOUT)
+        session.get.assert_has_calls([
+            mock.call(scroll_url, **_common),
+            mock.call().raise_for_status(),
+            mock.call().json(),
+            mock.call(scroll_url + '?scroll_param=param', **_common),
+        ])
+
+    def test_iter_users_retry(self, get_session):
+        session = get_session.return_value
         session.get.side_effect = RequestException
         client = IntercomClient(app_id='app_id', api_key='api_key')
         result = client.iter_users()
@@ -84,7 +180,8 @@ class IntercomClientTestCase(TestCase):
         self.assertRaises(RequestException, list, result)
         self.assertEqual(session.get.call_count, RETRY_COUNT)
 
-    def test_update_users(self, session):
+    def test_update_users(self, get_session):
+        session = get_session.return_value
         user_data = [
             dict(user_id=1,
                  custom_attributes={'key': 'value'},
@@ -134,14 +231,16 @@ class IntercomClientTestCase(TestCase):
         self.assertTrue(response.raise_for_status.call_count, 1)
         self.assertTrue(response.json.call_count, 1)
 
-    def test_update_users_retry(self, session):
+    def test_update_users_retry(self, get_session):
+        session = get_session.return_value
         session.post.side_effect = RequestException
         client = self._get_client()
 
         self.assertRaises(RequestException, client.update_users, [])
         self.assertEqual(session.post.call_count, RETRY_COUNT)
 
-    def test_create_notes(self, session):
+    def test_create_notes(self, get_session):
+        session = get_session.return_value
         data = [
             dict(user_id=1, body='body1'),
             dict(user_id=2, body='body2'),
@@ -176,7 +275,8 @@ class IntercomClientTestCase(TestCase):
             mock.call().json(),
         ])
 
-    def test_create_notes_retry(self, session):
+    def test_create_notes_retry(self, get_session):
+        session = get_session.return_value
         data = [
             dict(user_id=1, body='body1'),
             dict(user_id=2, body='body2'),
@@ -187,7 +287,8 @@ class IntercomClientTestCase(TestCase):
         self.assertRaises(RequestException, client.create_notes, data)
         self.assertEqual(session.post.call_count, RETRY_COUNT * len(data))
 
-    def test_subscribe(self, session):
+    def test_subscribe(self, get_session):
+        session = get_session.return_value
         hook_url = 'http://test.test/hook_url'
         topics = ['topic']
 
@@ -213,14 +314,16 @@ class IntercomClientTestCase(TestCase):
         self.assertEqual(response.raise_for_status.call_count, 1)
         self.assertEqual(response.json.call_count, 1)
 
-    def test_subscribe_retry(self, session):
+    def test_subscribe_retry(self, get_session):
+        session = get_session.return_value
         session.post.side_effect = RequestException
         client = self._get_client()
 
         self.assertRaises(RequestException, client.subscribe, '', '')
         self.assertEqual(session.post.call_count, RETRY_COUNT)
 
-    def test_unsubscribe(self, session):
+    def test_unsubscribe(self, get_session):
+        session = get_session.return_value
         subscription_id = 'some-subscription-id'
         client = self._get_client()
 
@@ -239,7 +342,8 @@ class IntercomClientTestCase(TestCase):
         self.assertEqual(response.raise_for_status.call_count, 1)
         self.assertEqual(response.json.call_count, 1)
 
-    def test_unsubscribe_retry(self, session):
+    def test_unsubscribe_retry(self, get_session):
+        session = get_session.return_value
         session.delete.side_effect = RequestException
         client = self._get_client()
 
@@ -248,3 +352,352 @@ class IntercomClientTestCase(TestCase):
 
     def _get_client(self):
         return IntercomClient('app_id', 'api_key')
+
+
+class SessionsTestCase(TestCase):
+    def test_session_per_app(self):
+        self.assertIs(get_session('app_1'), get_session('app_1'))
+        self.assertIsNot(get_session('app_1'), get_session('app_2'))
+        self.assertIs(IntercomClient('app_1', '').session,
+                      get_session('app_1'))
+
+    @mock.patch('app.intercom.service.HTTPAdapter')
+    def test_pool_size(self, HTTPAdapter):
+        create_session()
+        HTTPAdapter.assert_called_once_with(
+            pool_connections=1,
+            pool_maxsize=self.app.config['INTERCOM_POOL_SIZE'])
+
+    def test_pool_stats(self):
+        self.assertEqual({'connections': 0, 'requests': 0, 'idle': 0},
+                         get_pool_stats(get_session('app_3')))
+
+    def test_pool_stats_without_internals(self):
+        session = mock.Mock(adapters={'https://': object()})
+        self.assertEqual({'connections': 0, 'requests': 0, 'idle': 0},
+                         get_pool_stats(session))
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        super(RateLimiterTestCase, self).setUp()
+        self.limiter = RateLimiter('test-app-id')
+        self.limiter.redis.delete(self.limiter.key)
+
+    def tearDown(self):
+        self.limiter.redis.delete(self.limiter.key)
+        super(RateLimiterTestCase, self).tearDown()
+
+    def test_no_headers_no_wait(self):
+        self.assertEqual(self.limiter.reserve(), 0)
+
+    def test_requests_are_spread_until_reset(self):
+        self.limiter.update({'X-RateLimit-Remaining': '10',
+                             'X-RateLimit-Reset': str(int(time.time()) + 10)})
+
+        delays = [self.limiter.reserve() for _ in range(3)]
+
+        self.assertEqual(delays[0], 0)
+        self.assertTrue(0 < delays[1] < delays[2] <= 10)
+
+    def test_wait_for_reset_when_exhausted(self):
+        reset = int(time.time()) + 10
+        self.limiter.update({'X-RateLimit-Remaining': '0',
+                             'X-RateLimit-Reset': str(reset)})
+
+        self.assertTrue(8 < self.limiter.reserve() <= 10)
+
+    def test_no_burst_after_reset(self):
+        reset = int(time.time()) + 10
+        self.limiter.update({'X-RateLimit-Remaining': '10',
+                             'X-RateLimit-Reset': str(reset)})
+        self.limiter.reserve()
+
+        self.limiter.update({'X-RateLimit-Remaining': '0',
+                             'X-RateLimit-Reset': str(reset + 1)})
+        delays = [self.limiter.reserve() for _ in range(3)]
+
+        self.assertTrue(9 < delays[0] <= 11)
+        self.assertTrue(delays[0] < delays[1] < delays[2])
+
+
+class HooksBufferTestCase(TestCase):
+    def setUp(self):
+        super(HooksBufferTestCase, self).setUp()
+        self.buffer = HooksBuffer(-1)
+        self.buffer.redis.delete(self.buffer.key)
+        self.buffer.redis.zrem(self.buffer.index_key, -1)
+
+    def tearDown(self):
+        self.buffer.redis.delete(self.buffer.key)
+        self.buffer.redis.zrem(self.buffer.index_key, -1)
+        super(HooksBufferTestCase, self).tearDown()
+
+    def test_push_and_pop(self):
+        self.assertEqual(self.buffer.push('1@a.com', '2@b.com'), 2)
+        self.assertEqual(self.buffer.push('3@c.com'), 3)
+
+        self.assertEqual(self.buffer.pop(2), ['1@a.com', '2@b.com'])
+        self.assertEqual(self.buffer.pop(2), ['3@c.com'])
+        self.assertEqual(self.buffer.pop(2), [])
+
+    def test_expired(self):
+        self.buffer.push('1@a.com')
+
+        self.assertIn(-1, HooksBuffer.get_expired(0))
+        self.assertNotIn(-1, HooksBuffer.get_expired(60))
+
+    def test_partial_pop_updates_index(self):
+        with mock.patch('app.intercom.buffer.time') as buffer_time:
+            buffer_time.time.return_value = time.time() - 100
+            self.buffer.push('1@a.com', '2@b.com')
+
+        self.assertIn(-1, HooksBuffer.get_expired(60))
+
+        self.buffer.pop(1)
+        self.assertNotIn(-1, HooksBuffer.get_expired(60))
+
+        self.buffer.pop(1)
+        self.assertIsNone(
+            self.buffer.redis.zscore(self.buffer.index_key, -1))
+
+        self.buffer.pop(10)
+        self.assertNotIn(-1, HooksBuffer.get_expired(0))
+
+
+class PacerTestCase(TestCase):
+    def setUp(self):
+        super(PacerTestCase, self).setUp()
+        self.pacer = Pacer('test-app-id', rate=10)
+        self.pacer.redis.delete(self.pacer.key)
+
+    def tearDown(self):
+        self.pacer.redis.delete(self.pacer.key)
+        super(PacerTestCase, self).tearDown()
+
+    def test_requests_are_spread(self):
+        delays = [self.pacer.reserve() for _ in range(3)]
+
+        self.assertEqual(delays[0], 0)
+        self.assertAlmostEqual(delays[1], 0.1, places=2)
+        self.assertAlmostEqual(delays[2], 0.2, places=2)
+        self.assertEqual(self.pacer.metrics['requests'], 3)
+
+    def test_slots_are_shared_by_workers(self):
+        other = Pacer('test-app-id', rate=10)
+
+        self.assertEqual(self.pacer.reserve(), 0)
+        self.assertAlmostEqual(other.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(self.pacer.reserve(), 0.2, places=2)
+        self.assertEqual(other.metrics['requests'], 1)
+
+    def test_jitter(self):
+        pacer = Pacer('test-app-id', rate=10, jitter=0.5)
+        delays = [pacer.reserve() for _ in range(2)]
+
+        self.assertTrue(0 <= delays[0] <= 0.05)
+        self.assertTrue(0.09 <= delays[1] <= 0.15)
+
+    def test_no_rate_no_wait(self):
+        pacer = Pacer('test-app-id', rate=0)
+        self.assertEqual([pacer.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertFalse(pacer.redis.exists(pacer.key))
+
+    def test_rate_of_project(self):
+        self.assertEqual(get_notes_pacer('test-app-id', rate=2).rate, 2)
+        self.assertEqual(get_notes_pacer('test-app-id').rate,
+                         self.app.config['INTERCOM_NOTES_RATE'])
+
+
+def compile_postgresql(stmt):
+    compiled = stmt.compile(dialect=postgresql.dialect())
+    return ' '.join(str(compiled).split()), compiled.params
+
+
+class BulkSyncStatementTestCase(TestCase):
+    rows = [IntercomUser(project_id=1, user_id=1, domain='a.com',
+                         is_useful_domain=True)]
+
+    def test_changed_users(self):
+        sql, params = compile_postgresql(
+            IntercomUser.get_sync_statement(self.rows, pending=False))
+
+        self.assertIn(
+            'ON CONFLICT (project_id, user_id) DO UPDATE SET '
+            'domain = excluded.domain, '
+            'is_useful_domain = excluded.is_useful_domain, '
+            'is_awis_pending = (excluded.is_useful_domain AND '
+            '(intercom_user.is_awis_pending OR excluded.is_awis_pending)), '
+            'awis_pending_version = (intercom_user.awis_pending_version + ',
+            sql)
+        self.assertIn(
+            ' WHERE intercom_user.domain != excluded.domain OR '
+            'intercom_user.is_useful_domain != excluded.is_useful_domain '
+            'RETURNING intercom_user.user_id', sql)
+        self.assertFalse(params['is_awis_pending_m0'])
+
+    def test_all_pending(self):
+        sql, params = compile_postgresql(
+            IntercomUser.get_sync_statement(self.rows, all_pending=True))
+
+        self.assertNotIn(' WHERE ', sql)
+        self.assertIn('RETURNING intercom_user.user_id', sql)
+        self.assertTrue(params['is_awis_pending_m0'])
+
+
+class ReclassifyTestCase(TestCase):
+    def test_statement(self):
+        sql, params = compile_postgresql(
+            IntercomUser.get_reclassify_statement(['a.com'], False, 1000))
+
+        self.assertIn('UPDATE intercom_user SET is_useful_domain=', sql)
+        self.assertIn(
+            'WHERE intercom_user.id IN (SELECT intercom_user.id '
+            'FROM intercom_user WHERE intercom_user.domain = ANY (', sql)
+        self.assertIn('ORDER BY intercom_user.project_id, intercom_user.id '
+                      'LIMIT ', sql)
+        self.assertIn(
+            'RETURNING intercom_user.project_id, intercom_user.user_id, '
+            'intercom_user.domain', sql)
+        self.assertEqual(['a.com'], params['domains'])
+        self.assertIn(1000, params.values())
+
+    @mock.patch('app.intercom.models.db')
+    @mock.patch.object(IntercomUser, 'get_reclassify_statement')
+    def test_batches(self, get_reclassify_statement, db):
+        events = []
+        batches = [[(1, 1, 'a.com'), (1, 2, 'a.com'), (2, 3, 'a.com')],
+                   [(2, 4, 'a.com')], []]
+        db.session.execute.side_effect = \
+            lambda stmt: events.append('update') or batches.pop(0)
+        db.session.commit.side_effect = lambda: events.append('commit')
+
+        for changed in IntercomUser.iter_reclassified(['a.com'], False, 3):
+            events.append(dict(changed))
+
+        # Every batch is committed after it is handled
+        self.assertEqual([
+            'update', {1: [(1, 'a.com'), (2, 'a.com')], 2: [(3, 'a.com')]},
+            'commit', 'update', {2: [(4, 'a.com')]},
+            'commit', 'update', 'commit'], events)
+        get_reclassify_statement.assert_called_once_with(['a.com'], False, 3)
+
+    @mock.patch('app.intercom.models.db')
+    @mock.patch.object(IntercomUser, 'get_reclassify_statement')
+    def test_batch_is_rolled_back(self, get_reclassify_statement, db):
+        db.session.execute.return_value = [(1, 1, 'a.com')]
+
+        # The caller fails to handle the first batch
+        batches = IntercomUser.iter_reclassified(['a.com'], False, 3)
+        next(batches)
+        batches.close()
+
+        self.assertTrue(db.session.rollback.called)
+        self.assertFalse(db.session.commit.called)
+
+
+class IntercomUserTestCase(TestCase):
+    def setUp(self):
+        super(IntercomUserTestCase, self).setUp()
+        self.project = Project(
+            title='title',
+            intercom_app_id='intercom_app_id',
+            intercom_api_key='intercom_api_key',
+            aws_access_id='aws_access_id',
+            aws_secret_access_key='aws_secret_access_key',
+            user_id=self.user.id)
+        self.project.save()
+
+        domains = ['a.com'] * 3 + ['b.com'] * 2 + ['c.com', 'free.com']
+        self.db.session.add_all([
+            IntercomUser(project_id=self.project.id, user_id=i, domain=d,
+                         is_useful_domain=d != 'free.com')
+            for i, d in enumerate(domains, 1)])
+        self.db.session.commit()
+
+    @mock.patch('app.intercom.models.email_is_useful',
+                lambda email: not email.endswith('@free.com'))
+    def sync(self, user_ids=range(1, 8), since=None):
+        """ Import given users again (all of them by default).
+        """
+        users = IntercomUser.query.filter(
+            IntercomUser.user_id.in_(list(user_ids))).all()
+        users_data = [{'user_id': u.user_id, 'updated_at': 2,
+                       'email': 'user@' + u.domain} for u in users]
+
+        with mock.patch.object(Project, 'get_intercom_client') as client:
+            client.return_value.iter_pages.return_value = [(users_data, None)]
+            list(IntercomUser.iter_pages_and_sync(self.project, bulk=False,
+                                                  since=since))
+
+    def test_pending_domains(self):
+        self.assertEqual(
+            [], list(IntercomUser.iter_pending_domains(self.project, 3)))
+
+        self.sync()
+
+        self.assertEqual(
+            [['a.com'], ['b.com', 'c.com']],
+            list(IntercomUser.iter_pending_domains(self.project, 3)))
+
+    def test_only_synced_users_are_pending(self):
+        # Users 6 (c.com) and 7 are deleted from Intercom
+        self.sync(range(1, 6))
+
+        self.assertEqual(
+            [['a.com', 'b.com']],
+            list(IntercomUser.iter_pending_domains(self.project, 100)))
+
+    def test_incremental_sync(self):
+        self.sync(since=1)
+        self.assertEqual(
+            [], list(IntercomUser.iter_pending_domains(self.project, 100)))
+
+    def test_pending_users(self):
+        self.sync()
+
+        users, versions = IntercomUser.get_pending_users(
+            self.project, ['b.com', 'free.com'])
+        self.assertEqual({'b.com': ['4', '5']}, dict(users))
+
+        IntercomUser.clear_pending(self.project, versions)
+        self.assertEqual(
+            [['a.com', 'c.com']],
+            list(IntercomUser.iter_pending_domains(self.project, 100)))
+
+    def test_pending_marked_again(self):
+        self.sync()
+        _, versions = IntercomUser.get_pending_users(self.project, ['b.com'])
+
+        # Marked again while information is being fetched
+        self.sync()
+        IntercomUser.clear_pending(self.project, versions)
+
+        self.assertEqual(
+            [['a.com', 'b.com', 'c.com']],
+            list(IntercomUser.iter_pending_domains(self.project, 100)))
+
+    def test_reclassify_domain(self):
+        self.assertEqual(
+            [self.project.id],
+            IntercomUser.get_changed_projects('a.com', False))
+
+        chunks = IntercomUser.iter_changed_users(self.project.id, 'a.com',
+                                                 False, 2)
+        self.assertEqual([[1, 2], [3]],
+                         [[r.user_id for r in rows] for rows in chunks])
+
+        IntercomUser.set_useful_domain(self.project.id, 'a.com', False)
+        self.assertEqual([], IntercomUser.get_changed_projects('a.com', False))
+
+    @mock.patch('app.accounts.tasks.send_reclassified')
+    def test_reclassify_domains(self, send_reclassified):
+        from app.accounts.tasks import reclassify_domains
+
+        # Not PostgreSQL: users are changed domain by domain
+        reclassify_domains(['a.com', 'free.com'], False)
+
+        send_reclassified.assert_called_once_with(
+            self.project.id, [(1, 'a.com'), (2, 'a.com'), (3, 'a.com')],
+            False)
+        self.assertEqual([], IntercomUser.get_changed_projects('a.com', False))
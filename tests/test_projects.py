@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 
 import mock
@@ -5,6 +6,7 @@ from flask import url_for
 
 from tests.base import TestCase
 from app.accounts.models import Project, User
+from app.intercom.buffer import HookEventsBuffer
 
 
 class ProjectsTestCase(TestCase):
@@ -116,6 +118,7 @@ class ProjectUpdateTestCase(TestCase):
             title='title1',
             intercom_app_id='intercom_app_id1',
             intercom_api_key='intercom_api_key1',
+            intercom_notes_rate=2.5,
             aws_access_id='aws_access_id1',
             aws_secret_access_key='aws_secret_access_key1',
         )
@@ -153,6 +156,8 @@ class ProjectUpdateTestCase(TestCase):
 
     @mock.patch('app.accounts.views.handle_intercom_users')
     def test_force_job_start(self, handle_intercom_users):
+        self.project.intercom_users_updated_at = 1000
+        self.project.save()
         self.login()
 
         data = dict(
@@ -168,3 +173,76 @@ class ProjectUpdateTestCase(TestCase):
 
         self.assert200(response)
         handle_intercom_users.delay.assert_called_once_with(self.project.id)
+
+        # Re-Import fetches only users updated since the previous one
+        project = Project.query.filter(Project.id == self.project.id).first()
+        self.assertEqual(1000, project.intercom_users_updated_at)
+
+
+class IntercomHooksTestCase(TestCase):
+    def setUp(self):
+        super(IntercomHooksTestCase, self).setUp()
+        self.project = Project(
+            title='title',
+            intercom_app_id='intercom_app_id',
+            intercom_api_key='intercom_api_key',
+            intercom_webhooks_internal_secret='internal-secret',
+            aws_access_id='aws_access_id',
+            aws_secret_access_key='aws_secret_access_key',
+            user_id=self.user.id)
+        self.project.save()
+        self.url = url_for('accounts.handle_intercom_hooks',
+                           internal_secret='internal-secret')
+        self.events = HookEventsBuffer(self.project.id)
+        self.events.pop(len(self.events))
+
+    def tearDown(self):
+        self.events.pop(len(self.events))
+        super(IntercomHooksTestCase, self).tearDown()
+
+    def post(self, url, data):
+        return self.client.post(url, data=json.dumps(data),
+                                content_type='application/json')
+
+    @mock.patch('app.accounts.views.ingest_hooks')
+    def test_event_is_buffered(self, ingest_hooks):
+        user = {'user_id': '1', 'email': 'user@domain.com'}
+        response = self.post(self.url, {'data': {'item': user}})
+
+        self.assert200(response)
+        self.assertEqual([user], [json.loads(e) for e in self.events.pop(10)])
+        self.assertFalse(ingest_hooks.delay.called)
+
+    def test_unknown_secret(self):
+        url = url_for('accounts.handle_intercom_hooks',
+                      internal_secret='unknown')
+        response = self.post(url, {'data': {'item': {}}})
+        self.assert400(response)
+
+    def test_invalid_event(self):
+        response = self.post(self.url, {'data': {}})
+        self.assert400(response)
+
+    @mock.patch('app.intercom.models.IntercomUser.get_or_create')
+    def test_events_are_kept_on_error(self, get_or_create):
+        from app.accounts.tasks import ingest_hooks
+
+        get_or_create.side_effect = ValueError
+        users = [{'user_id': str(i), 'email': 'user@domain.com'}
+                 for i in range(3)]
+        self.events.push(*[json.dumps(u) for u in users])
+
+        self.assertRaises(ValueError, ingest_hooks, self.project.id,
+                          force=True)
+        self.assertEqual(users, [json.loads(e) for e in self.events.pop(10)])
+
+    @mock.patch('app.accounts.tasks.flush_hooks_buffer')
+    @mock.patch('app.accounts.tasks.ingest_hooks')
+    def test_flush_per_project(self, ingest_hooks, flush_hooks_buffer):
+        from app.accounts.tasks import flush_hooks_buffers
+
+        self.events.push(json.dumps({'user_id': '1', 'email': 'u@a.com'}))
+        flush_hooks_buffers()
+
+        ingest_hooks.delay.assert_any_call(self.project.id, force=True)
+        self.assertFalse(ingest_hooks.called)